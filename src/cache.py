@@ -0,0 +1,387 @@
+# -:- coding: utf-8 -:-
+"""
+A cache of wire format responses, warmed up from a hot-set of popular questions.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+import dns.flags
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+
+
+log = logging.getLogger(__name__)
+
+SAVE_INTERVAL = 300  # seconds between writes of the hot-set file
+PREFETCH_INTERVAL = 1  # seconds between checks for entries about to expire
+PREFETCH_WINDOW = 0.1  # prefetch in the last fraction of an entry's lifetime
+
+# wire format of an OPT record without options, after its root owner name
+OPT = struct.Struct("!HHBBHH")
+
+
+def question_key(data):
+    """
+    Parse a wire format query into a cache key.
+
+    Only plain queries with a single question, and at most an EDNS0 OPT
+    record without options, can be answered from cache, and no zone
+    transfers. Return a tuple of the key and the offset of the end of the
+    question, or (None, None) for anything else.
+
+    The key holds the lowercased query name in wire format, the query type
+    and class, the RD flag and whether EDNS0 and DNSSEC OK were set, i.e.
+    everything the response depends on apart from the ID and the case of
+    the query name.
+    """
+    if len(data) < 17:
+        return None, None
+
+    flags, qdcount, ancount, nscount, arcount = struct.unpack("!HHHHH", data[2:12])
+    if flags & dns.flags.QR or dns.opcode.from_flags(flags) != dns.opcode.QUERY:
+        return None, None
+    if qdcount != 1 or ancount or nscount or arcount > 1:
+        return None, None
+
+    # walk the labels of the query name; compression makes no sense here
+    pos = 12
+    while True:
+        length = ord(data[pos:pos + 1])
+        if length & 0xC0:
+            return None, None
+        pos += 1 + length
+        if length == 0:
+            break
+        if pos > 12 + 255 or pos >= len(data):
+            return None, None
+
+    qend = pos + 4
+    if qend > len(data):
+        return None, None
+    qtype, qclass = struct.unpack("!HH", data[pos:qend])
+    if qtype in (dns.rdatatype.AXFR, dns.rdatatype.IXFR):
+        # zone transfers are never stored, and would be prefetched forever
+        return None, None
+
+    edns = dnssec = False
+    if arcount:
+        if len(data) != qend + 1 + OPT.size or data[qend:qend + 1] != b"\x00":
+            return None, None
+        rdtype, _, _, version, ednsflags, rdlength = OPT.unpack(data[qend + 1:])
+        if rdtype != dns.rdatatype.OPT or version or rdlength:
+            return None, None
+        edns = True
+        dnssec = bool(ednsflags & dns.flags.DO)
+    elif len(data) != qend:
+        return None, None
+
+    key = (data[12:pos].lower(), qtype, qclass, flags & dns.flags.RD, edns, dnssec)
+    return key, qend
+
+
+def key_to_wire(key):
+    """
+    Return a wire format query for a cache key.
+    """
+    qname, qtype, qclass, rd, edns, dnssec = key
+
+    wire = struct.pack("!HHHHHH", 0, rd, 1, 0, 0, 1 if edns else 0)
+    wire += qname + struct.pack("!HH", qtype, qclass)
+    if edns:
+        wire += b"\x00" + OPT.pack(dns.rdatatype.OPT, 4096, 0, 0,
+                                   dns.flags.DO if dnssec else 0, 0)
+    return wire
+
+
+def response_ttl(msg):
+    """
+    Return how long a response may be cached, or 0 if it shouldn't be.
+    """
+    if msg.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        return 0
+
+    rrsets = msg.answer + msg.authority + msg.additional
+    if not rrsets:
+        return 0
+    return min(rrset.ttl for rrset in rrsets)
+
+
+class HeavyHitters(object):
+    """
+    Bounded sketch of the most frequent keys in a stream.
+
+    A batched variant of the Space-Saving algorithm: up to twice the capacity
+    is counted, after which only the top half is kept. Keys that show up
+    afterwards start counting from the highest count thrown away, so that
+    counts are overestimated rather than newcomers being starved.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._counts = dict()
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, count=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, self._floor) + count
+            if len(self._counts) >= 2 * self.capacity:
+                self._prune()
+
+    def _prune(self):
+        ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        self._floor = max(self._floor, ranked[self.capacity][1])
+        self._counts = dict(ranked[:self.capacity])
+
+    def top(self, k=None):
+        """
+        Return up to k (default: capacity) most frequent keys and their counts.
+        """
+        with self._lock:
+            ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:k or self.capacity]
+
+    def save(self, path):
+        """
+        Write the top keys to the hot-set file at path.
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            for key, count in self.top():
+                qname, qtype, qclass, rd, edns, dnssec = key
+                f.write("{} {} {} {} {} {} {}\n".format(
+                    count, dns.name.from_wire(qname, 0)[0].to_text(),
+                    dns.rdataclass.to_text(qclass), dns.rdatatype.to_text(qtype),
+                    rd, int(edns), int(dnssec)))
+        os.rename(tmp, path)
+
+    def load(self, path):
+        """
+        Add the keys and counts in the hot-set file at path.
+
+        Return the keys read, most frequent first.
+        """
+        keys = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    count, qname, qclass, qtype, rd, edns, dnssec = line.split()
+                    qname = dns.name.from_text(qname).to_wire().lower()
+                    key = (qname, dns.rdatatype.from_text(qtype),
+                           dns.rdataclass.from_text(qclass), int(rd),
+                           bool(int(edns)), bool(int(dnssec)))
+                except Exception:
+                    log.warning("Skipping bad line in hot-set file: %r", line)
+                    continue
+                self.add(key, int(count))
+                keys.append(key)
+        return keys
+
+
+class ResponseCache(object):
+    """
+    Cache of wire format responses, keyed by question_key().
+
+    Entries expire after the lowest TTL in the response, capped by max_ttl.
+    When full, the least recently used entry is evicted. Every lookup is
+    counted in a HeavyHitters sketch, so popular entries can be prefetched.
+
+    Entries are stamped with a generation. After the resolver data has been
+    reloaded, a new generation is started, popular entries are refreshed,
+    and the remaining stale ones are dropped.
+    """
+
+    def __init__(self, size=10000, max_ttl=3600, hot=None):
+        self.size = size
+        self.max_ttl = max_ttl
+        self.hot = hot if hot is not None else HeavyHitters()
+        self.generation = 0
+
+        # key -> (wire, expires, ttl, generation), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, data):
+        """
+        Look up a wire format query.
+
+        Return a tuple of its cache key, or None if it can't be cached, and
+        the cached response with the query's ID and question patched in, or
+        None on a cache miss.
+        """
+        key, qend = question_key(data)
+        if key is None:
+            return None, None
+
+        self.hot.add(key)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        if entry is None or entry[0] is None or entry[1] <= time.time():
+            return key, None
+
+        # same question means same length, so everything after it fits
+        wire = entry[0]
+        return key, data[:2] + wire[2:12] + data[12:qend] + wire[qend:]
+
+    def store(self, key, msg, wire):
+        """
+        Store wire format response of msg under key, if it may be cached.
+
+        Responses that may not be cached are remembered as such for max_ttl,
+        so that they are not prefetched over and over again.
+        """
+        ttl = min(response_ttl(msg), self.max_ttl)
+        if ttl <= 0:
+            wire, ttl = None, self.max_ttl
+
+        with self._lock:
+            if self._entries.pop(key, None) is None and len(self._entries) >= self.size:
+                self._entries.popitem(last=False)
+            self._entries[key] = (wire, time.time() + ttl, ttl, self.generation)
+
+    def expiring(self, keys):
+        """
+        Return those of keys whose entries are missing or about to expire.
+        """
+        now = time.time()
+        expiring = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None or entry[3] != self.generation or \
+                    entry[1] - now <= entry[2] * PREFETCH_WINDOW:
+                expiring.append(key)
+        return expiring
+
+    def new_generation(self):
+        self.generation += 1
+
+    def prune(self):
+        """
+        Drop entries from earlier generations.
+        """
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if entry[3] != self.generation]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+
+class Warmer(object):
+    """
+    Keep the response cache warm.
+
+    Upon start and reload, the most popular questions from the hot-set file
+    and the live HeavyHitters sketch are resolved in a background thread.
+    While running, popular entries are refreshed shortly before they expire,
+    and the hot-set file is rewritten every SAVE_INTERVAL seconds.
+
+    The resolve callable takes a wire format query, and should resolve it
+    bypassing the cache, storing the result in it.
+    """
+
+    def __init__(self, cache, resolve, path=None, top=1000):
+        self.cache = cache
+        self.resolve = resolve
+        self.path = path
+        self.top = top
+        self.warm = threading.Event()  # set once the first warm-up is done
+
+        self._reload = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(name="warmer", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and save the hot-set file.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.save()
+
+    def reload(self):
+        """
+        Refresh the cache after the resolver data was reloaded.
+        """
+        self._reload.set()
+
+    def save(self):
+        if self.path:
+            try:
+                self.cache.hot.save(self.path)
+            except (IOError, OSError):
+                log.exception("Cannot write hot-set file %s", self.path)
+
+    def prefetch(self, keys):
+        """
+        Resolve keys into the cache; return the number of keys resolved.
+        """
+        count = 0
+        for key in keys:
+            if self._stop.is_set():
+                break
+            try:
+                self.resolve(key_to_wire(key))
+            except Exception:
+                log.exception("Oddness while prefetching %r", key)
+            else:
+                count += 1
+        return count
+
+    def hot_keys(self):
+        return [key for key, _ in self.cache.hot.top(self.top)]
+
+    def warm_up(self):
+        """
+        Resolve the most popular questions into a new cache generation.
+        """
+        start = time.time()
+        self.cache.new_generation()
+        count = self.prefetch(self.hot_keys())
+        stale = self.cache.prune()
+        log.info("Warmed up %d responses in %.2f s, dropped %d stale ones",
+                    count, time.time() - start, stale)
+
+    def _run(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                self.cache.hot.load(self.path)
+            except (IOError, OSError):
+                log.exception("Cannot read hot-set file %s", self.path)
+
+        self.warm_up()
+        self.warm.set()
+
+        saved = time.time()
+        while not self._stop.wait(PREFETCH_INTERVAL):
+            if self._reload.is_set():
+                self._reload.clear()
+                self.warm_up()
+            else:
+                self.prefetch(self.cache.expiring(self.hot_keys()))
+
+            if time.time() - saved >= SAVE_INTERVAL:
+                self.save()
+                saved = time.time()
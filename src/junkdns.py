@@ -7,7 +7,6 @@ JunkDNS - An experimental DNS resolver to query data sets via DNS.
 
 #
 # TODO:
-# - Deduplicate UDP vs TCP code
 # - Unicode support
 # - Proper logging
 # - Proper daemonize
@@ -16,12 +15,30 @@ JunkDNS - An experimental DNS resolver to query data sets via DNS.
 from __future__ import absolute_import
 
 import argparse
+import ast
+import contextlib
+import errno
+import functools
+import importlib
 import logging
+import os
 import pkgutil
+import signal
+import socket
+import stat
 import struct
+import sys
 import threading
+import timeit
 
+import dns.flags
 import dns.message
+import dns.opcode
+import dns.rcode
+
+import cache
+import profiling
+import transfer
 
 try:
     # python 3
@@ -30,12 +47,21 @@ except ImportError:
     # python 2
     import SocketServer as socketserver
 
+try:
+    # python 3.4 and up
+    import asyncio
+except ImportError:
+    asyncio = None
+
 
 log = logging.getLogger(__name__)
 
 # look for resolver modules here
 RESOLVERS_PATH = "resolvers"
 
+# first file descriptor handed to us by a socket-activating supervisor
+LISTEN_FDS_START = 3
+
 
 def from_wire(data, origin=None):
     return dns.message.from_wire(data, origin=origin)
@@ -48,45 +74,200 @@ def to_wire(msg, origin):
         return None
 
 
-class DnsRequestHandler(socketserver.BaseRequestHandler):
+def error_response(data, rcode):
+    """
+    Return wire format error response to a query that could not be decoded.
 
-    resolver = None  # DNS resolver module to query
-    origin = None  # DNS origin to serve from; None means root
+    Only the header of the query is used; None is returned if even that is
+    unusable, or if the message is a response itself.
+    """
+    if len(data) < 12:
+        return None
 
+    qid, flags = struct.unpack("!HH", data[:4])
+    if flags & dns.flags.QR:
+        return None
 
-class DnsUdpRequestHandler(DnsRequestHandler):
+    res = dns.message.Message(id=qid)
+    res.flags = dns.flags.QR | (flags & dns.flags.RD) | \
+        dns.opcode.to_flags(dns.opcode.from_flags(flags))
+    res.set_rcode(rcode)
+    return res.to_wire()
+
+
+def recv_exactly(sock, length):
     """
-    Single-threaded UDP request handler
+    Receive exactly length bytes from a stream socket.
+
+    Return None if the connection is closed before that.
     """
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
 
-    def handle(self):
-        data, socket = self.request
+
+class DnsRequestHandler(socketserver.BaseRequestHandler):
+
+    resolver = None  # DNS resolver module to query
+    origin = None  # DNS origin to serve from; None means root
+    profiler = None  # profiling.Profiler to report stage timings to, if any
+    cache = None  # cache.ResponseCache to answer repeated questions from, if any
+    loop = None  # AsyncLoop to run resolver coroutines on, if any
+    transfers = None  # transfer.Transfers to serve zone transfers from, if any
+    query_timeout = 5  # seconds to wait for resolver coroutines
+
+    @classmethod
+    def respond(cls, data, client_address=None, prefetch=False):
+        """
+        Return wire format response to wire format query, or None if no reply.
+        """
+        return cls.respond_batch([data], [client_address], prefetch)[0]
+
+    @classmethod
+    def respond_batch(cls, datas, client_addresses, prefetch=False):
+        """
+        Return wire format responses to wire format queries, None where no reply.
+
+        Repeated questions are answered from the cache. When prefetching, the
+        cache is not consulted but only updated.
+
+        Time spent decoding, resolving and encoding is reported to the
+        profiler while it is running, and so is time spent answering from
+        the cache, as the hit stage.
+        """
+        responses = [None] * len(datas)
+        keys = [None] * len(datas)
+        profiler = cls.profiler
+
+        store = cls.cache
+        todo = range(len(datas))
+        if store is not None:
+            todo = []
+            hits, hit_time = 0, 0.0
+            for i, data in enumerate(datas):
+                if prefetch:
+                    keys[i] = cache.question_key(data)[0]
+                else:
+                    start = timeit.default_timer()
+                    keys[i], responses[i] = store.lookup(data)
+                    if responses[i] is not None:
+                        hits += 1
+                        hit_time += timeit.default_timer() - start
+                if responses[i] is None:
+                    todo.append(i)
+
+            if hits and profiler is not None and profiler.running:
+                profiler.record(hits, hit=hit_time)
+
+        if not todo:
+            return responses
 
         # TODO this could go in class init for speed
-        if self.origin:
-            origin = dns.name.from_text(self.origin)
+        if cls.origin:
+            origin = dns.name.from_text(cls.origin)
         else:
             origin = None
 
-        # TODO if fails, return SRVFAIL
-        msg = from_wire(data, origin)
-
-        log.info("Handling query for: %s", msg.question)
-        log.debug("Message is: %s", msg)
-
-        try:
-            res = self.resolver.query(msg)
-            log.debug("Response is: %s", res)
-        except:
-            log.exception("Oddness while processing query")
-            raise
-            # @TODO should give a SERVFAIL here instead of nothing
-        else:
-            if res:
-                data = to_wire(res, origin)
-                socket.sendto(data, self.client_address)
+        start = timeit.default_timer()
+
+        transfers = cls.transfers
+        pending = []
+        msgs = []
+        for i in todo:
+            try:
+                msg = from_wire(datas[i], origin)
+            except Exception:
+                log.info("Malformed query from %s", client_addresses[i])
+                responses[i] = error_response(datas[i], dns.rcode.FORMERR)
             else:
+                if transfers is not None and transfers.is_transfer(msg):
+                    # datagrams only tell whether there's anything to transfer;
+                    # zones are named in full, whatever the origin
+                    res = transfers.respond(from_wire(datas[i]), tcp=False)[0]
+                    responses[i] = to_wire(res, None)
+                    continue
+                log.info("Handling query for: %s", msg.question)
+                log.debug("Message is: %s", msg)
+                pending.append(i)
+                msgs.append(msg)
+        decoded = timeit.default_timer()
+
+        results = cls.resolve(msgs)
+        resolved = timeit.default_timer()
+
+        for i, res in zip(pending, results):
+            if not res:
                 log.warning("No result from query")
+                continue
+
+            log.debug("Reply from thread %s: %s", threading.current_thread(), res)
+            responses[i] = to_wire(res, origin)
+
+            if keys[i] is not None:
+                store.store(keys[i], res, responses[i])
+
+        if profiler is not None and profiler.running and msgs:
+            profiler.record(len(msgs),
+                            decode=decoded - start,
+                            resolve=resolved - decoded,
+                            encode=timeit.default_timer() - resolved)
+
+        return responses
+
+    @classmethod
+    def resolve(cls, msgs):
+        """
+        Return the resolver's responses to msgs, in order.
+
+        More than one message goes to query_batch(), if the resolver has it.
+        Otherwise query_async() is used, if the resolver has it and an event
+        loop is running, or query() if not. Messages the resolver fails on,
+        or whose coroutines take longer than query_timeout, get a SERVFAIL
+        response.
+        """
+        resolver = cls.resolver
+
+        if len(msgs) > 1 and hasattr(resolver, "query_batch"):
+            try:
+                results = resolver.query_batch(msgs)
+                if len(results) == len(msgs):
+                    return results
+                log.error("Batch of %d queries gave %d responses", len(msgs), len(results))
+            except Exception:
+                log.exception("Oddness while processing batch, retrying one by one")
+
+        if cls.loop is not None and hasattr(resolver, "query_async"):
+            # start all coroutines before waiting for any
+            futures = cls.loop.submit([resolver.query_async(msg) for msg in msgs])
+            deadline = timeit.default_timer() + cls.query_timeout
+            calls = [functools.partial(cls.loop.result, future, deadline)
+                     for future in futures]
+        else:
+            calls = [functools.partial(resolver.query, msg) for msg in msgs]
+
+        results = []
+        for msg, call in zip(msgs, calls):
+            try:
+                res = call()
+            except Exception:
+                log.exception("Oddness while processing query")
+                res = dns.message.make_response(msg)
+                res.set_rcode(dns.rcode.SERVFAIL)
+            results.append(res)
+        return results
+
+
+class DnsUdpRequestHandler(DnsRequestHandler):
+    """
+    Single-threaded UDP request handler
+
+    Datagrams are read and answered in batches by BatchingMixIn, through
+    respond_batch(), so there's no handle() of its own.
+    """
 
 
 class DnsTcpRequestHandler(DnsRequestHandler):
@@ -94,51 +275,378 @@ class DnsTcpRequestHandler(DnsRequestHandler):
     Threaded TCP request handler
     """
 
+    timeout = 10  # seconds to wait for a slow client
+
+    def setup(self):
+        self.request.settimeout(self.timeout)
+
     def handle(self):
 
-        data = self.request.recv(2)
-        length = struct.unpack("!H", data)[0]
-        data = self.request.recv(length)
+        try:
+            data = recv_exactly(self.request, 2)
+            if data is None:
+                return
+            length = struct.unpack("!H", data)[0]
+            data = recv_exactly(self.request, length)
+            if data is None:
+                log.info("Connection closed before end of query")
+                return
+        except socket.timeout:
+            log.info("Timeout waiting for query from %s", self.client_address)
+            return
+
+        if self.transfers is not None and transfer.is_transfer_query(data):
+            self.transfer(data)
+            return
+
+        data = self.respond(data, self.client_address)
+
+        if data is not None:
+            wire = struct.pack("!H", len(data)) + data
+            self.request.sendall(wire)
+
+    def transfer(self, data):
+        """
+        Send a zone transfer in reply to an AXFR or IXFR query.
+        """
+        # zones are named in full, whatever the origin
+        try:
+            msg = from_wire(data)
+        except Exception:
+            log.info("Malformed transfer query from %s", self.client_address)
+            data = error_response(data, dns.rcode.FORMERR)
+            if data is not None:
+                self.request.sendall(struct.pack("!H", len(data)) + data)
+            return
+
+        log.info("Handling transfer for: %s", msg.question)
+        res, chunks = self.transfers.respond(msg)
+
+        data = to_wire(res, None)
+        self.request.sendall(struct.pack("!H", len(data)) + data)
+        if chunks is not None:
+            for chunk in chunks.stream(msg.id):
+                self.request.sendall(chunk)
+            log.info("Transferred %d messages to %s", chunks.messages + 1,
+                     self.client_address)
+
+
+class AsyncLoop(object):
+    """
+    Event loop in a background thread, to run resolver coroutines on.
 
-        # TODO this could go in class init for speed
-        if self.origin:
-            origin = dns.name.from_text(self.origin)
-        else:
-            origin = None
+    Request handler threads submit coroutines and wait for their results,
+    while the loop runs them concurrently.
+    """
 
-        msg = from_wire(data, origin)
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(name="asyncio", target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
 
+    def submit(self, coros):
+        """
+        Schedule coroutines; return a concurrent.futures.Future for each.
+        """
+        return [asyncio.run_coroutine_threadsafe(coro, self.loop) for coro in coros]
+
+    def result(self, future, deadline):
+        """
+        Wait for the result of a future until deadline, a default_timer() value.
+
+        A coroutine still running by then is cancelled, and TimeoutError raised.
+        """
         try:
-            res = self.resolver.query(msg)
-        except:
-            log.exception("Oddness while processing query")
-            # @TODO should give a SERVFAIL here instead of nothing
-        else:
-            if res:
-                cur_thread = threading.current_thread()
-                log.debug("Reply from thread %s: %s", cur_thread, res)
+            return future.result(max(0, deadline - timeit.default_timer()))
+        finally:
+            # no effect on coroutines that are done
+            future.cancel()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
 
-                data = to_wire(res, origin)
-                wire = struct.pack("!H", len(data)) + data
-                self.request.sendall(wire)
+class BatchingMixIn(object):
+    """
+    Mix-in for datagram servers to answer all queued queries at once.
+
+    Whenever the socket becomes readable, up to batch_size datagrams are
+    read and passed to the request handler's respond_batch() together, so
+    resolvers can amortise work over them with query_batch().
+    """
+
+    batch_size = 64
+
+    # socketserver has no public hook to take over request reading
+    def _handle_request_noblock(self):
+        requests = []
+        while len(requests) < self.batch_size:
+            try:
+                requests.append(self.socket.recvfrom(self.max_packet_size,
+                                                     socket.MSG_DONTWAIT))
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.warning("Error receiving query: %s", e)
+                break
+
+        if not requests:
+            return
+
+        datas = [data for data, _ in requests]
+        addresses = [address for _, address in requests]
+        try:
+            responses = self.RequestHandlerClass.respond_batch(datas, addresses)
+        except Exception:
+            log.exception("Oddness while processing batch of %d queries", len(datas))
+            return
+
+        for data, address in zip(responses, addresses):
+            if data is None:
+                continue
+            elif not address:
+                # unbound Unix domain datagram clients can't be replied to
+                log.warning("Cannot reply to anonymous client")
             else:
-                log.warning("No result from query")
+                try:
+                    self.socket.sendto(data, address)
+                except socket.error as e:
+                    log.warning("Error sending response to %s: %s", address, e)
+
+
+class DnsUdpServer(BatchingMixIn, socketserver.UDPServer):
+    """
+    Single-threaded UDP server
+    """
+
+
+class DnsUnixDatagramServer(BatchingMixIn, socketserver.UnixDatagramServer):
+    """
+    Single-threaded Unix domain datagram server
+    """
+
+
+class DnsTcpServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded TCP server
+    """
+
+    # the default of 5 makes the kernel reset connections under concurrent load
+    request_queue_size = 128
+
+
+class DnsUnixStreamServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Threaded Unix domain stream server
+    """
+
+    request_queue_size = DnsTcpServer.request_queue_size
+
+
+def listen_fds():
+    """
+    Return file descriptors of listening sockets passed in by a supervisor.
+
+    Follows the systemd socket activation protocol: descriptors are passed
+    sequentially from LISTEN_FDS_START onwards, their number is in LISTEN_FDS
+    and LISTEN_PID must match our own process id. The environment variables
+    are removed so they are not inherited by any child processes.
+    """
+    try:
+        pid = int(os.environ.pop("LISTEN_PID"))
+        count = int(os.environ.pop("LISTEN_FDS"))
+    except (KeyError, ValueError):
+        return []
+    finally:
+        os.environ.pop("LISTEN_FDNAMES", None)
+
+    if pid != os.getpid():
+        return []
+
+    return list(range(LISTEN_FDS_START, LISTEN_FDS_START + count))
+
+
+def socket_from_fd(fd):
+    """
+    Wrap an inherited file descriptor in a socket of the proper family and type.
+    """
+    # python 2, and python 3 before 3.7, can't tell family and type from the
+    # descriptor, so probe it first
+    probe = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    socktype = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    address = probe.getsockname()
+    probe.close()
+
+    if not isinstance(address, tuple):
+        family = socket.AF_UNIX
+    elif len(address) == 4:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+
+    sock = socket.fromfd(fd, family, socktype)
+    os.close(fd)  # fromfd() made a duplicate
+    return sock
+
+
+def server_from_socket(sock):
+    """
+    Create a server of the appropriate kind around an already bound socket.
+    """
+    socktype = sock.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    unix = sock.family == socket.AF_UNIX
+
+    if socktype == socket.SOCK_DGRAM:
+        cls = DnsUnixDatagramServer if unix else DnsUdpServer
+        handler = DnsUdpRequestHandler
+    elif socktype == socket.SOCK_STREAM:
+        cls = DnsUnixStreamServer if unix else DnsTcpServer
+        handler = DnsTcpRequestHandler
+    else:
+        raise RuntimeError("Unsupported socket type {} passed in.".format(socktype))
+
+    # don't create and bind a socket of our own, but use the one provided
+    server = cls(None, handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
+    if socktype == socket.SOCK_STREAM:
+        server.server_activate()
+    return server
+
+
+def unix_server(path, cls, handler):
+    """
+    Create a server listening on a Unix domain socket at path.
+
+    A stale socket left behind by a previous run is removed first. The path
+    is remembered as socket_path, so the file is removed on exit again.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+    server = cls(path, handler)
+    server.socket_path = path
+    return server
+
+
+def remove_sockets(servers):
+    """
+    Remove the Unix domain socket files bound by servers.
+
+    Only files created by unix_server() are removed: sockets passed in by a
+    supervisor are its to keep, so it can start us again on demand.
+    """
+    for server in servers:
+        path = getattr(server, "socket_path", None)
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def serve(servers):
+    """
+    Run servers until interrupted, or until the first one is shut down.
+
+    All servers but the first run in their own thread; the first one runs in
+    the main thread, so that it receives KeyboardInterrupt.
+    """
+    threads = []
+    for server in servers[1:]:
+        thread = threading.Thread(name=str(server.server_address),
+                                  target=server.serve_forever)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servers[0].server_close()
+        for server in servers[1:]:
+            server.shutdown()
+            server.server_close()
+        for thread in threads:
+            thread.join()
+        remove_sockets(servers)
 
 
-def load_modules(path):
+def find_modules(path):
     """
-    Load modules in directory pointed to by path dynamically.
+    Find modules in directory pointed to by path, without importing them.
 
-    From http://stackoverflow.com/a/8556471/543431
+    Return a dictionary of module names and their metadata, i.e. the NAME,
+    HELP and DESC constants, which are read from the module source. Modules
+    whose names start with an underscore are helpers, not resolvers.
     """
     modules = dict()
-    for importer, name, _ in pkgutil.iter_modules([path]):
-        pkgname = path + "." + name
-        module = importer.find_module(pkgname).load_module(pkgname)
-        modules[name] = module
+    for importer, name, ispkg in pkgutil.iter_modules([path]):
+        if name.startswith("_"):
+            continue
+        if ispkg:
+            filename = os.path.join(path, name, "__init__.py")
+        else:
+            filename = os.path.join(path, name + ".py")
+
+        with open(filename) as f:
+            tree = ast.parse(f.read(), filename)
+
+        metadata = dict()
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                    and isinstance(node.targets[0], ast.Name) \
+                    and node.targets[0].id in ("NAME", "HELP", "DESC"):
+                metadata[node.targets[0].id] = ast.literal_eval(node.value)
+
+        modules[name] = metadata
     return modules
 
 
+def reload(resolver, warmer=None, transfers=None):
+    """
+    Rebuild resolver state, and refresh cached responses and zone afterwards.
+    """
+    log.warning("Reloading resolver")
+    try:
+        if hasattr(resolver, "init"):
+            resolver.init()
+        if transfers is not None:
+            transfers.update(resolver.zone())
+    except:
+        log.exception("Oddness while reloading resolver")
+    else:
+        if warmer is not None:
+            warmer.reload()
+
+
+def load_module(path, name):
+    """
+    Import module name from directory pointed to by path.
+    """
+    return importlib.import_module(path + "." + name)
+
+
+@contextlib.contextmanager
+def timed(phases, phase):
+    """
+    Time the enclosed block, and append phase, duration and resident memory
+    afterwards to phases.
+    """
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        phases.append((phase, timeit.default_timer() - start,
+                       profiling.resident_memory()))
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(prog="junkdns",
@@ -152,11 +660,45 @@ if __name__ == "__main__":
                        help="DNS origin to use, e.g. _tldns.mydomain.com. (default: %(default)s)")
     parser.add_argument("--tcp", "-t", dest="tcp", action="store_true",
                        help="start a TCP listener on the same port")
+    parser.add_argument("--unix", "-u", dest="unix", metavar="PATH",
+                       help="also listen on Unix domain datagram socket PATH, "
+                            "and stream socket PATH.tcp if --tcp is given")
+    parser.add_argument("--fd", dest="fds", type=int, action="append", default=[],
+                       metavar="FD",
+                       help="serve on pre-opened listening socket FD instead of "
+                            "--host and --port; may be repeated. Sockets passed "
+                            "in via LISTEN_FDS are picked up automatically")
 #     parser.add_argument("--pool", "-p", dest="pool", type=int, default=10,
 #                        help="thread pool size of TCP listener (default: %(default)d)")
     parser.add_argument("--debug", "-D", dest="debug", default="warn",
                         choices=["debug", "info", "warn", "error"],
                         help="debugging level")
+    parser.add_argument("--startup-profile", dest="startup_profile", action="store_true",
+                        help="print the time taken by each startup phase, and "
+                             "the resident memory after it")
+    parser.add_argument("--profile-seconds", dest="profile_seconds", type=float, default=10,
+                        metavar="SECONDS",
+                        help="profile for this long when sent SIGUSR1 (default: %(default)s)")
+    parser.add_argument("--profile-dir", dest="profile_dir", metavar="DIR",
+                        help="directory to write profiles to (default: temporary directory)")
+    parser.add_argument("--cache", dest="cache", type=int, default=10000, metavar="SIZE",
+                        help="number of responses to cache, if the resolver allows it, 0 to disable "
+                             "(default: %(default)d)")
+    parser.add_argument("--cache-ttl", dest="cache_ttl", type=int, default=3600,
+                        metavar="SECONDS",
+                        help="maximum time to cache a response (default: %(default)d)")
+    parser.add_argument("--hotset", dest="hotset", metavar="FILE",
+                        help="file to keep the most popular questions in, "
+                             "to warm up the cache from on start")
+    parser.add_argument("--hotset-size", dest="hotset_size", type=int, default=1000,
+                        metavar="K",
+                        help="number of popular questions to track and keep warm "
+                             "(default: %(default)d)")
+    parser.add_argument("--warmup-wait", dest="warmup_wait", action="store_true",
+                        help="don't start serving before the cache is warmed up")
+    parser.add_argument("--transfer", dest="transfer", action="store_true",
+                        help="serve the resolver's data set as a zone over AXFR "
+                             "and IXFR, the former only over TCP")
 
     # add resolver-specific section
     subparsers = parser.add_subparsers(dest="resolver",  # used to find the selected resolver
@@ -165,60 +707,149 @@ if __name__ == "__main__":
                                                     "Run multiple resolvers as separate daemons.",
                                         help="available resolvers")
 
-    # load resolver modules
-    resolvers = load_modules(RESOLVERS_PATH)
-    for name, module in resolvers.items():
+    phases = []
+
+    # find resolver modules, but don't load them yet
+    with timed(phases, "find resolvers"):
+        resolvers = find_modules(RESOLVERS_PATH)
+
+    subparsers_by_name = dict()
+    for name, metadata in sorted(resolvers.items()):
         try:
-            subparser = subparsers.add_parser(name=module.NAME,
-                                              help=module.HELP,
-                                              description=module.DESC)
-        except AttributeError:
+            # help is added once the resolver is loaded and its options are known
+            subparser = subparsers.add_parser(name=metadata["NAME"],
+                                              help=metadata["HELP"],
+                                              description=metadata["DESC"],
+                                              add_help=False)
+        except KeyError:
             # logging is not initialised here yet
             raise RuntimeError("Resolver module {} should sport NAME, HELP and DESC.".format(name))
         else:
-            module.configure_parser(subparser)
+            subparsers_by_name[metadata["NAME"]] = name, subparser
+
+    # find out which resolver was chosen, and load only that one
+    args, _ = parser.parse_known_args()
+    if args.resolver is None:
+        parser.error("no resolver given")
+
+    name, subparser = subparsers_by_name[args.resolver]
+    with timed(phases, "import " + name):
+        resolver = load_module(RESOLVERS_PATH, name)
+
+    if args.transfer and not hasattr(resolver, "zone"):
+        parser.error("resolver {} cannot be transferred as a zone".format(name))
+
+    subparser.add_argument("-h", "--help", action="help",
+                           help="show this help message and exit")
+    resolver.configure_parser(subparser)
 
     args = parser.parse_args()
 
+    # take over sockets passed in by a supervisor, if any
+    socks = [socket_from_fd(fd) for fd in args.fds + listen_fds()]
+
+    # AXFR is refused over UDP, so transfers need a stream listener; --tcp
+    # only adds one on --host and --port without passed in sockets, or on --unix
+    streams = [sock for sock in socks
+               if sock.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE) == socket.SOCK_STREAM]
+    if args.transfer and not streams and not (args.tcp and (args.unix or not socks)):
+        parser.error("--transfer needs --tcp or a TCP socket passed in")
+
     # configure log level
     loglevel = eval("logging.{}".format(args.debug.upper()))
     logging.basicConfig(level=loglevel)
 
-    # find chosen resolver
-    resolver = resolvers[args.resolver]
-
     # set module-specific arguments via the set_defaults() function provided by module
-    try:
-        args.func(args)
-    except AttributeError:
-        pass
+    with timed(phases, "configure " + name):
+        try:
+            args.func(args)
+        except AttributeError:
+            pass
+
+    # build resolver state
+    with timed(phases, "init " + name):
+        if hasattr(resolver, "init"):
+            resolver.init()
+
+    # precompute zone transfers of resolver data
+    transfers = None
+    if args.transfer:
+        with timed(phases, "zone " + name):
+            transfers = transfer.Transfers()
+            transfers.update(resolver.zone())
+
+    if args.startup_profile:
+        for phase, duration, rss in phases:
+            sys.stderr.write("{:<30} {:8.1f} ms {:8.1f} MB\n".format(
+                phase, duration * 1000, (rss or 0) / 1048576.0))
 
     # set request handler defaults (both UDP and TCP)
     DnsRequestHandler.resolver = resolver
     DnsRequestHandler.origin = args.origin
+    DnsRequestHandler.transfers = transfers
+
+    # run coroutines of resolvers that have them, all on one event loop
+    if asyncio is not None and hasattr(resolver, "query_async"):
+        DnsRequestHandler.loop = AsyncLoop()
+
+    # sample running server on demand, without interrupting it
+    profiler = profiling.Profiler(args.profile_dir)
+    DnsRequestHandler.profiler = profiler
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: profiler.start(args.profile_seconds))
+
+    # answer popular questions from cache, and keep it warm
+    warmer = None
+    if args.cache > 0 and not getattr(resolver, "CACHEABLE", False):
+        log.info("Resolver %s doesn't allow caching its answers", name)
+    elif args.cache > 0:
+        DnsRequestHandler.cache = cache.ResponseCache(args.cache, args.cache_ttl,
+                                                      cache.HeavyHitters(args.hotset_size))
+        warmer = cache.Warmer(DnsRequestHandler.cache,
+                              lambda data: DnsRequestHandler.respond(data, prefetch=True),
+                              args.hotset, args.hotset_size)
+        warmer.start()
+        if args.warmup_wait:
+            warmer.warm.wait()
+
+    # reload resolver data in the background, while still serving
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: threading.Thread(
+                      name="reload", target=reload,
+                      args=(resolver, warmer, transfers)).start())
+
+    servers = []
+
+    # serve on sockets passed in by a supervisor if any, otherwise bind our own
+    for sock in socks:
+        servers.append(server_from_socket(sock))
+
+    if not socks:
+        # run single-threaded udp server in main thread
+        DnsUdpServer.allow_reuse_address = True
+        servers.append(DnsUdpServer((args.host, args.port), DnsUdpRequestHandler))
+
+        # tread out threaded tcp server
+        if args.tcp:
+            DnsTcpServer.allow_reuse_address = True
+            servers.append(DnsTcpServer((args.host, args.port), DnsTcpRequestHandler))
+
+    if args.unix:
+        servers.append(unix_server(args.unix, DnsUnixDatagramServer,
+                                   DnsUdpRequestHandler))
+        if args.tcp:
+            servers.append(unix_server(args.unix + ".tcp", DnsUnixStreamServer,
+                                       DnsTcpRequestHandler))
+
+    # stop as gracefully when asked by a supervisor as when interrupted, but
+    # without raising in the middle of a request, where it might be caught;
+    # shutdown() waits for the main thread to stop serving, so call it apart
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: threading.Thread(
+                      name="shutdown", target=servers[0].shutdown).start())
 
-    tcpserver = tcpthread = None
-
-    # tread out threaded tcp server
-    if args.tcp:
-        socketserver.ThreadingTCPServer.allow_reuse_address = True
-        tcpserver = socketserver.ThreadingTCPServer((args.host, args.port),
-                                                    DnsTcpRequestHandler)
-        tcpthread = threading.Thread(name="tcp", target=tcpserver.serve_forever)
-        tcpthread.start()
-
-    # run single-threaded udp server in main thread
-    socketserver.UDPServer.allow_reuse_address = True
-    udpserver = socketserver.UDPServer((args.host, args.port),
-                                       DnsUdpRequestHandler)
     try:
-        udpserver.serve_forever()
-    except KeyboardInterrupt:
-        pass
+        serve(servers)
     finally:
-        udpserver.server_close()
-        if tcpserver:
-            tcpserver.shutdown()
-            tcpserver.server_close()
-        if tcpthread:
-            tcpthread.join()
+        if warmer is not None:
+            warmer.stop()
@@ -0,0 +1,176 @@
+# -:- coding: utf-8 -:-
+"""
+A sampling profiler to look inside a running JunkDNS server.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+
+log = logging.getLogger(__name__)
+
+# innermost frames of threads waiting for work, as function and file name;
+# such as server loops waiting in select(), and the warmer between rounds
+IDLE_FRAMES = frozenset([
+    ("select", "selectors.py"),  # python 3
+    ("_eintr_retry", "SocketServer.py"),  # python 2
+    ("wait", "threading.py"),
+])
+
+
+def resident_memory():
+    """
+    Return resident set size of this process in bytes, or None if unknown.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Profiler(object):
+    """
+    Sample the stacks of all other busy threads at a fixed interval for a while.
+
+    Stacks are counted in collapsed form, i.e. one line per unique stack with
+    its frames separated by semicolons, which is what flamegraph.pl expects.
+    Request handlers report how long each stage of a request took through
+    record() while the profiler is running.
+
+    Threads waiting for work, i.e. with their innermost frame in IDLE_FRAMES,
+    are left out, so that the stacks show where the work is done.
+
+    Nothing is sampled or recorded while the profiler is idle, so it can be
+    left in place in production and started when needed.
+    """
+
+    def __init__(self, directory=None, interval=0.005):
+        self.directory = directory or tempfile.gettempdir()
+        self.interval = interval  # seconds between samples
+        self.running = False
+
+        # reentrant, as start() runs from a signal handler, which may interrupt
+        # record() on the main thread while it holds the lock
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stacks = collections.Counter()
+        self._stages = dict()
+        self._labels = dict()  # cache of frame labels per code object
+
+    def start(self, seconds):
+        """
+        Profile for the given number of seconds in a background thread.
+
+        Return False if a profile is being taken already.
+        """
+        with self._lock:
+            if self.running:
+                return False
+
+            self._stacks = collections.Counter()
+            self._stages = dict()
+            self.running = True
+
+            self._thread = threading.Thread(name="profiler", target=self._run,
+                                            args=(seconds,))
+            self._thread.daemon = True
+            self._thread.start()
+
+        log.warning("Profiling for %s seconds", seconds)
+        return True
+
+    def join(self):
+        """
+        Wait for the current profile to finish.
+        """
+        if self._thread is not None:
+            self._thread.join()
+
+    def record(self, requests=1, **stages):
+        """
+        Add the durations in seconds of request handling stages.
+
+        Requests handled as a batch are recorded once with their number, so
+        the mean is per request, while the maximum is per batch.
+        """
+        with self._lock:
+            for stage, duration in stages.items():
+                count, total, longest = self._stages.get(stage, (0, 0.0, 0.0))
+                self._stages[stage] = (count + requests, total + duration,
+                                       max(longest, duration))
+
+    def _label(self, code):
+        try:
+            return self._labels[code]
+        except KeyError:
+            label = "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                        code.co_firstlineno)
+            self._labels[code] = label
+            return label
+
+    def _sample(self, own):
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (code.co_name, os.path.basename(code.co_filename)) in IDLE_FRAMES:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+
+            self._stacks[";".join(stack)] += 1
+
+    def _run(self, seconds):
+        own = threading.current_thread().ident
+        deadline = timeit.default_timer() + seconds
+
+        try:
+            while timeit.default_timer() < deadline:
+                self._sample(own)
+                time.sleep(self.interval)
+        except:
+            log.exception("Oddness while profiling")
+        finally:
+            with self._lock:
+                self.running = False
+            self.dump()
+
+    def dump(self):
+        """
+        Write collapsed stacks and stage timings of the last profile to files.
+
+        Return the names of the files written.
+        """
+        base = os.path.join(self.directory, "junkdns-{}-{}".format(
+            os.getpid(), time.strftime("%Y%m%dT%H%M%S")))
+
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+            stages = sorted(self._stages.items())
+
+        with open(base + ".collapsed", "w") as f:
+            for stack, count in stacks:
+                f.write("{} {}\n".format(stack, count))
+
+        with open(base + ".stages", "w") as f:
+            f.write("{:<10} {:>8} {:>12} {:>12} {:>12}\n".format(
+                "stage", "count", "total ms", "mean ms", "max ms"))
+            for stage, (count, total, longest) in stages:
+                f.write("{:<10} {:>8} {:>12.3f} {:>12.3f} {:>12.3f}\n".format(
+                    stage, count, total * 1000, total * 1000 / count, longest * 1000))
+
+        log.warning("Profile written to %s.collapsed and %s.stages", base, base)
+        return base + ".collapsed", base + ".stages"
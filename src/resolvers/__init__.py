@@ -8,7 +8,20 @@
 #     HELP
 #     DESC
 #
-# and methods:
+# These are read from the module source without importing it, so they must be
+# plain string literals. Only the selected module gets imported, so keep the
+# import itself cheap and build any expensive state in init() instead.
+#
+# Modules may also set:
+#
+#     CACHEABLE = True
+#
+# to have their answers cached in wire format. Only set it if answers depend
+# on nothing but the query name, regardless of its case, the query type and
+# class, the RD flag and whether EDNS0 and DNSSEC OK were set; not on the
+# client, say. Names in the answer that equal the query name get its case.
+#
+# Modules should expose the following methods:
 #
 #     def configure_parser(parser):
 #         """
@@ -18,6 +31,15 @@
 #         """
 #         pass
 #     
+#     def init():
+#         """
+#         Build resolver state, such as loading data sets, after configuration.
+#         
+#         Optional; called before the first query is served, and again to reload
+#         upon SIGHUP. Queries are served meanwhile, so replace state in one go.
+#         """
+#         pass
+#     
 #     def query(msg):
 #         """
 #         Return answer to provided DNS question.
@@ -25,4 +47,37 @@
 #         Create appropriate skeleton response message via dns.message.make_response(msg).
 #         """
 #         pass
+#     
+#     def query_batch(msgs):
+#         """
+#         Return list of answers to provided list of DNS questions, in order.
+#         
+#         Optional; used instead of query() when several queries arrive at once,
+#         e.g. a burst of UDP packets, so work can be shared between them. If it
+#         fails, query() is used for each question instead.
+#         """
+#         pass
+#     
+#     async def query_async(msg):
+#         """
+#         Coroutine returning answer to provided DNS question.
+#         
+#         Optional, python 3.5 and up; used instead of query() if present, for
+#         resolvers that wait on I/O. Coroutines run concurrently on a single
+#         event loop in a background thread, so they must not block it. Those
+#         taking over 5 seconds are cancelled, and answered with SERVFAIL. Keep
+#         query() too, to serve on python versions without asyncio.
+#         """
+#         pass
+#     
+#     def zone():
+#         """
+#         Return the whole data set as a list of rrsets, starting with the SOA of its apex.
+#         
+#         Optional; enables serving AXFR and IXFR with --transfer. Called after
+#         init(), also upon reload. Bump the SOA serial whenever the data changes.
+#         The apex may differ from the origin, e.g. to keep records that only
+#         make sense to zone consumers out of the way of regular queries.
+#         """
+#         pass
 #
\ No newline at end of file
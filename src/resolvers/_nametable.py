@@ -0,0 +1,225 @@
+# -:- coding: utf-8 -:-
+"""
+Compact, read-only tables of domain names for resolvers serving large data sets.
+
+Plain Python strings, tuples and dicts cost tens of bytes per object, which
+adds up to hundreds of bytes per name, in every worker process. Here every
+distinct label is stored once, in a LabelPool packed into a single bytes
+object, and names are stored as runs of integer label IDs in flat arrays.
+No Python objects are kept per name at all.
+
+Names are stored with their labels reversed, top-level label first, and
+sorted. Since label IDs are assigned in sorted label order, comparing the
+ID arrays of two names compares them label by label from the right, much
+like DNS canonical ordering does, and all names below a given name end up
+adjacent. Lookups of labels and names go through open addressing hash
+tables, which are arrays too.
+
+The underscore keeps this module from being listed as a resolver.
+"""
+
+from __future__ import absolute_import
+
+import array
+
+
+def split(name):
+    """
+    Split a relative text name into lowercased labels, top-level label first.
+    """
+    labels = name.lower().split(".")
+    labels.reverse()
+    return labels
+
+
+def typecode(count):
+    """
+    Return the smallest array type code to hold integers up to count.
+    """
+    for code in ("B", "H", "I", "L"):
+        if count < 1 << (8 * array.array(code).itemsize):
+            return code
+    raise OverflowError("Too many labels: {}".format(count))
+
+
+if hasattr(array.array, "tobytes"):
+    # python 3
+    def key_hash(key):
+        return hash(key.tobytes())
+else:
+    # python 2
+    def key_hash(key):
+        return hash(key.tostring())
+
+
+def hash_index(hashes):
+    """
+    Return an open addressing hash table for a sequence of hash values.
+
+    Slots hold the index of the entry plus one, or zero when empty. The table
+    is kept at most half full, so probing linearly finds an entry quickly.
+    """
+    size = 1
+    while size < 2 * len(hashes):
+        size *= 2
+    mask = size - 1
+
+    slots = array.array(typecode(len(hashes) + 1), [0]) * size
+    for i, h in enumerate(hashes):
+        slot = h & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = i + 1
+    return slots
+
+
+class LabelPool(object):
+    """
+    Sorted set of distinct labels, packed into one UTF-8 encoded string.
+
+    A label's ID is its rank, so IDs compare like the labels themselves.
+    """
+
+    __slots__ = ("_blob", "_offsets", "_slots")
+
+    def __init__(self, labels):
+        encoded = sorted(set(label.encode("utf-8") for label in labels))
+        self._blob = b"".join(encoded)
+        self._offsets = array.array("I", [0])
+        for label in encoded:
+            self._offsets.append(self._offsets[-1] + len(label))
+        self._slots = hash_index([hash(label) for label in encoded])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        Return UTF-8 encoded label by ID.
+        """
+        return self._blob[self._offsets[i]:self._offsets[i + 1]]
+
+    def label(self, i):
+        return self[i].decode("utf-8")
+
+    def find(self, label):
+        """
+        Return the ID of label, or None if it's not in the pool.
+        """
+        encoded = label.encode("utf-8")
+        slots = self._slots
+        mask = len(slots) - 1
+        slot = hash(encoded) & mask
+        while slots[slot]:
+            i = slots[slot] - 1
+            if self[i] == encoded:
+                return i
+            slot = (slot + 1) & mask
+        return None
+
+
+class NameTable(object):
+    """
+    Immutable set of relative domain names, each with a small integer value.
+
+    Built from (name, value) pairs of text names without trailing dot; for
+    duplicates, the last value wins. Names are matched case-insensitively.
+    Iterating gives the names and values in DNS canonical order.
+    """
+
+    __slots__ = ("pool", "_ids", "_offsets", "_values", "_slots")
+
+    def __init__(self, names):
+        # share label objects while building, there are far fewer labels than names
+        labels = dict()
+        entries = dict()
+        for name, value in names:
+            key = tuple(labels.setdefault(label, label) for label in split(name))
+            entries[key] = value
+
+        self.pool = LabelPool(labels)
+        del labels
+
+        # keys of label IDs sort like the labels themselves
+        find = self.pool.find
+        ordered = sorted(entries, key=lambda key: [find(label) for label in key])
+
+        self._ids = array.array(typecode(len(self.pool)),
+                                (find(label) for key in ordered for label in key))
+        self._offsets = array.array("I", [0]) * (len(ordered) + 1)
+        self._values = array.array("B", [0]) * len(ordered)
+        for i, key in enumerate(ordered):
+            self._offsets[i + 1] = self._offsets[i] + len(key)
+            self._values[i] = entries[key]
+        del entries, ordered
+
+        self._slots = hash_index([key_hash(self[i]) for i in range(len(self))])
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, i):
+        """
+        Return the reversed label IDs of the i-th name, for comparison.
+        """
+        return self._ids[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.name(i), self._values[i]
+
+    def name(self, i):
+        labels = [self.pool.label(label) for label in self[i]]
+        labels.reverse()
+        return ".".join(labels)
+
+    def value(self, i):
+        return self._values[i]
+
+    def key(self, labels):
+        """
+        Return the reversed label IDs of a name given as reversed labels.
+
+        Return None if some label is unknown, in which case the table holds
+        neither the name nor any name below it.
+        """
+        ids = array.array(self._ids.typecode)
+        for label in labels:
+            i = self.pool.find(label)
+            if i is None:
+                return None
+            ids.append(i)
+        return ids
+
+    def child(self, key, label):
+        """
+        Return the key of label below key, or None if label is unknown.
+        """
+        i = self.pool.find(label)
+        if i is None:
+            return None
+        child = key[:]
+        child.append(i)
+        return child
+
+    def find(self, key):
+        """
+        Return the index of the name with key, or None if it's not there.
+        """
+        slots = self._slots
+        mask = len(slots) - 1
+        slot = key_hash(key) & mask
+        while slots[slot]:
+            i = slots[slot] - 1
+            if self[i] == key:
+                return i
+            slot = (slot + 1) & mask
+        return None
+
+    def get(self, name, default=None):
+        """
+        Return the value of a text name, or default if it's not there.
+        """
+        key = self.key(split(name))
+        i = None if key is None else self.find(key)
+        return default if i is None else self._values[i]
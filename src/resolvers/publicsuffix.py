@@ -11,18 +11,29 @@ This resolver returns a PTR record pointing to the top-level domain of the
 hostname in question. When the --txt option is given, it will also return
 additional informational TXT records.
 
+Queries for other record types get a negative answer carrying the SOA record
+of the origin, so that downstream resolvers can cache it.
+
 The list of current top-level domains can be explicitly downloaded upon startup
 via the --fetch argument.
 """
 
+import calendar
+import dns.exception
+import dns.flags
 import dns.message
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import io
 import logging
+import os
 import sys
+import time
 
-# remove current directory from path to load a module with the same name as us
-oldpath, sys.path = sys.path, sys.path[1:]
-import publicsuffix
-sys.path = oldpath
+from resolvers import _nametable
 
 
 """
@@ -32,10 +43,87 @@ TTL = 14400  # serve all records with this TTL
 SERVE_TXT = True  # serve additional TXT records
 LIST_FETCH = False  # download fresh copy of public suffix list
 LIST_URL = "http://mxr.mozilla.org/mozilla-central/source/netwerk/dns/effective_tld_names.dat?raw=1"
+ORIGIN = dns.name.root  # zone apex we are authoritative for
+NAMESERVER = "localhost."  # name server to put in NS and SOA records
+HOSTMASTER = "hostmaster"  # SOA contact mailbox, relative to origin
+SERIAL = 1  # SOA serial, set from the list version by init()
+NEGATIVE_TTL = 3600  # SOA minimum, i.e. TTL for caching negative answers
+RULES = "_rules"  # zone below the origin to transfer the rules of the list in
+CACHEABLE = True  # answers don't depend on the case of the query name
+
+# origin records, built once by build_origin()
+SOA = None
+NS = None
+NEGATIVE_SOA = None
 
 
 log = logging.getLogger(__name__)
-psl = publicsuffix.PublicSuffixList()
+psl = None  # public suffix list, loaded by init()
+
+
+class SuffixList(object):
+    """
+    The public suffix list, stored compactly in a name table.
+
+    Answers like publicsuffix.PublicSuffixList, whose list file it reads,
+    but takes a fraction of the memory.
+    """
+
+    # kinds of rules, stored as values in the name table
+    RULE, EXCEPTION, IMPLIED = 0, 1, 2
+
+    def __init__(self, input_file):
+        self.version = None  # as given in the list, if at all
+
+        rules = dict()
+        for line in input_file:
+            line = line.strip()
+            if line.startswith("// VERSION:"):
+                self.version = line.split(":", 1)[1].strip()
+            if line.startswith("//") or not line:
+                continue
+
+            rule = line.split()[0].lstrip(".")
+            kind = self.RULE
+            if rule.startswith("!"):
+                kind, rule = self.EXCEPTION, rule[1:]
+            rules[rule] = kind
+
+            # like the original, any parent of a rule counts as a rule as well
+            labels = rule.split(".")
+            for i in range(1, len(labels)):
+                rules.setdefault(".".join(labels[i:]), self.IMPLIED)
+
+        self.rules = _nametable.NameTable(rules.items())
+
+    def _match(self, hits, labels, key, kind):
+        """
+        Mark the kind of the rules matching the last len(key) labels.
+        """
+        depth = len(key) + 1
+        hits[-depth] = kind
+
+        if depth < len(labels):
+            for label in ("*", labels[depth - 1]):
+                child = self.rules.child(key, label)
+                i = None if child is None else self.rules.find(child)
+                if i is not None:
+                    self._match(hits, labels, child, self.rules.value(i))
+
+    def get_public_suffix(self, domain):
+        """
+        Return the registrable part of domain, i.e. its public suffix and one more label.
+        """
+        parts = domain.lower().strip(".").split(".")
+        labels = parts[::-1]
+        hits = [None] * len(parts)
+
+        # any top-level label is a public suffix, as if there were a * rule
+        self._match(hits, labels, self.rules.key([]), self.RULE)
+
+        for i, kind in enumerate(hits):
+            if kind is not None and kind != self.EXCEPTION:
+                return ".".join(parts[i:])
 
 
 def configure_parser(parser):
@@ -46,10 +134,16 @@ def configure_parser(parser):
     """
 
     def set_defaults(args):
-        global TTL, SERVE_TXT, LIST_FETCH, LIST_URL
+        global TTL, SERVE_TXT, LIST_FETCH, LIST_URL, NAMESERVER, NEGATIVE_TTL, ORIGIN
 
         TTL = args.publicsuffix_ttl
         SERVE_TXT = args.publicsuffix_txt
+        NAMESERVER = args.publicsuffix_ns
+        NEGATIVE_TTL = args.publicsuffix_negttl
+
+        # the origin is a global option
+        if getattr(args, "origin", None):
+            ORIGIN = dns.name.from_text(args.origin)
 
         if args.publicsuffix_fetch in (True, False):
             LIST_FETCH = args.publicsuffix_fetch
@@ -71,9 +165,145 @@ def configure_parser(parser):
     parser.add_argument("--notxt", dest="publicsuffix_txt", action="store_false",
                         default=SERVE_TXT,
                         help="do not serve additional TXT records")
+    parser.add_argument("--ns", dest="publicsuffix_ns",
+                        default=NAMESERVER, metavar="NAME",
+                        help="name server to list in NS and SOA records of the origin "
+                             "(default: %(default)s)")
+    parser.add_argument("--negttl", dest="publicsuffix_negttl", type=int,
+                        default=NEGATIVE_TTL, metavar="TTL",
+                        help="TTL for caching negative answers (default: %(default)d)")
 
     return parser
 
+
+def build_origin():
+    """
+    Build the SOA and NS records of the origin.
+    
+    These are the same for every response, so they are built only once.
+    They are not kept in wire format though: dnspython renders every
+    response as a whole, compressing names across all its records, so
+    splicing in precomputed records would mean rendering responses by hand.
+    """
+    global SOA, NS, NEGATIVE_SOA
+
+    nameserver = dns.name.from_text(NAMESERVER, origin=ORIGIN)
+    hostmaster = dns.name.from_text(HOSTMASTER, origin=ORIGIN)
+
+    soa = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.SOA,
+                              "{} {} {} 3600 600 86400 {}".format(
+                                  nameserver, hostmaster, SERIAL, NEGATIVE_TTL))
+    ns = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.NS,
+                             nameserver.to_text())
+
+    SOA = dns.rrset.from_rdata(ORIGIN, TTL, soa)
+    NS = dns.rrset.from_rdata(ORIGIN, TTL, ns)
+    # RFC 2308: negative answers are cached for the lesser of SOA TTL and minimum
+    NEGATIVE_SOA = dns.rrset.from_rdata(ORIGIN, min(TTL, NEGATIVE_TTL), soa)
+
+
+def init():
+    """
+    Build resolver state once configuration is done.
+
+    Parsing the public suffix list is the expensive part of starting up, so
+    it's done here rather than upon import.
+    """
+    global psl, SERIAL
+
+    path = list_file()
+    with io.open(path, encoding="utf-8") as f:
+        suffixes = SuffixList(f)
+
+    SERIAL = list_serial(suffixes.version, os.path.getmtime(path))
+    build_origin()
+    psl = suffixes
+
+
+def list_serial(version, mtime):
+    """
+    Return SOA serial for a list, i.e. the time of its version in seconds
+    since the epoch, or the time it was last modified if it has no version.
+    """
+    if version:
+        try:
+            return calendar.timegm(time.strptime(version, "%Y-%m-%d_%H-%M-%S_UTC"))
+        except ValueError:
+            log.warning("Unknown list version %s, using file time as serial", version)
+    return int(mtime)
+
+
+def list_file():
+    """
+    Return the path of the list that comes with the publicsuffix package.
+
+    Only the list is used, so the package is found without importing it,
+    which would cost several megabytes per process.
+    """
+    # remove current directory from path to find a package with the same name as us
+    oldpath, sys.path = sys.path, sys.path[1:]
+    try:
+        try:
+            # python 3
+            from importlib.util import find_spec
+        except ImportError:
+            # python 2
+            import imp
+            directory = imp.find_module("publicsuffix")[1]
+        else:
+            spec = find_spec("publicsuffix")
+            if spec is None:
+                raise ImportError("No module named publicsuffix")
+            directory = os.path.dirname(spec.origin)
+    finally:
+        sys.path = oldpath
+
+    return os.path.join(directory, "public_suffix_list.dat")
+
+
+def zone():
+    """
+    Return the rules of the list as a zone of their own, named RULES below
+    the origin, with the SOA and NS records of the origin.
+
+    Each rule is a TXT record holding the rule as written in the list, in
+    IDNA, under the name it applies to: *.ck and !www.ck go under ck and
+    www.ck respectively. So the zone holds no wildcards, and no answers
+    for names below the origin, which a recursor loading it could mistake
+    for ours. Rules that cannot be encoded in IDNA are left out.
+    """
+    suffixes = psl
+    apex = dns.name.from_text(RULES, ORIGIN)
+    rrsets = [dns.rrset.from_rdata(apex, TTL, SOA[0]),
+              dns.rrset.from_rdata(apex, TTL, NS[0])]
+
+    owners = dict()
+    for name, kind in suffixes.rules:
+        if kind == SuffixList.IMPLIED:
+            continue
+        wildcard = name.startswith("*.")
+        try:
+            owner = dns.name.from_unicode(name[2:] if wildcard else name, apex)
+        except (dns.exception.DNSException, UnicodeError):
+            log.debug("Leaving %s out of zone", name)
+            continue
+
+        rule = owner.relativize(apex).to_text()
+        if wildcard:
+            rule = "*." + rule
+        if kind == SuffixList.EXCEPTION:
+            rule = "!" + rule
+        rdata = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.TXT, '"{}"'.format(rule))
+
+        if owner in owners:
+            owners[owner].add(rdata)
+        else:
+            owners[owner] = dns.rrset.from_rdata(owner, TTL, rdata)
+            rrsets.append(owners[owner])
+
+    return rrsets
+
+
 def validate(msg):
     """
     Filter messages that are bad or we can't handle.
@@ -98,12 +328,36 @@ def validate(msg):
     return dns.rcode.NOERROR
 
 
-def query(msg):
+def query_batch(msgs):
+    """
+    Return answers to provided DNS questions, in order.
+
+    Names asked for more than once in the batch are looked up only once, and
+    all in the same list, even if it is reloaded meanwhile.
+    """
+    lookup = psl.get_public_suffix
+    suffixes = dict()
+
+    def cached_lookup(name):
+        try:
+            return suffixes[name]
+        except KeyError:
+            suffix = suffixes[name] = lookup(name)
+            return suffix
+
+    return [query(msg, cached_lookup) for msg in msgs]
+
+
+def query(msg, lookup=None):
     """
     Return answer to provided DNS question.
      
     Create appropriate skeleton response message via dns.message.make_response(msg).
+    Suffixes are looked up with the lookup callable, if given.
     """
+    if lookup is None:
+        lookup = psl.get_public_suffix
+
     res = dns.message.make_response(msg)
 
     # validate query
@@ -114,58 +368,85 @@ def query(msg):
     if rcode != dns.rcode.NOERROR:
         return res
 
+    # we are authoritative for everything below the origin
+    res.flags |= dns.flags.AA
+
     # this is just one query in reality, really, but let's not assume that
     for query in msg.question:
 
-        name = query.name.to_unicode(omit_final_dot=True)
+        # names arrive relative to the origin, unless it wasn't configured
+        qname = query.name.derelativize(ORIGIN)
 
-        # only deal with PTR queries
-        if query.rdtype not in (dns.rdatatype.PTR, dns.rdatatype.ANY):
-            res.set_rcode(dns.rcode.NXDOMAIN)
-            log.info("Skipping query type %d", query.rdtype)
+        if not qname.is_subdomain(ORIGIN):
+            res.set_rcode(dns.rcode.REFUSED)
+            res.flags &= ~dns.flags.AA
+            log.info("Refusing query outside origin: %s", qname)
+            break
+
+        # the origin itself only has SOA and NS records
+        if qname == ORIGIN:
+            if query.rdtype in (dns.rdatatype.SOA, dns.rdatatype.ANY):
+                res.answer.append(SOA)
+            if query.rdtype in (dns.rdatatype.NS, dns.rdatatype.ANY):
+                res.answer.append(NS)
+            if not res.answer:
+                res.authority.append(NEGATIVE_SOA)
             continue
 
+        name = qname.relativize(ORIGIN).to_unicode(omit_final_dot=True)
+
         try:
-            suffix = psl.get_public_suffix(name)
-        except:
+            suffix = lookup(name)
+        except Exception:
             res.set_rcode(dns.rcode.SERVFAIL)
+            res.flags &= ~dns.flags.AA
             log.exception("Oddness while looking up suffix")
             # don't process further questions since we've set rcode
             break
 
-        if suffix:
-            suffix += "."
+        if not suffix:
+            res.set_rcode(dns.rcode.NXDOMAIN)
+            res.authority.append(NEGATIVE_SOA)
+            continue
+
+        # names only have PTR records, so other types get a NODATA answer
+        if query.rdtype not in (dns.rdatatype.PTR, dns.rdatatype.ANY):
+            res.authority.append(NEGATIVE_SOA)
+            log.info("No data for query type %d", query.rdtype)
+            continue
 
-            # answer section
-            rdata = suffix
+        suffix += "."
+
+        # answer section
+        rdata = suffix
+        # https://github.com/rthalley/dnspython/issues/44
+        try:
+            # dnspython3
+            rrset = dns.rrset.from_text(query.name, TTL,
+                    dns.rdataclass.IN, dns.rdatatype.PTR,
+                    rdata)
+        except AttributeError:
+            # dnspython2
+            rrset = dns.rrset.from_text(query.name, TTL,
+                    dns.rdataclass.IN, dns.rdatatype.PTR,
+                    rdata.encode("idna"))
+        res.answer.append(rrset)
+
+        if SERVE_TXT:
+            # additional section
+            tld = query.name.split(2)[-1].to_text(omit_final_dot=True).lower()
+            rdata = '"see: http://en.wikipedia.org/wiki/.{}"'.format(tld)
             # https://github.com/rthalley/dnspython/issues/44
             try:
-                # dnspython3
-                rrset = dns.rrset.from_text(query.name, TTL,
-                        dns.rdataclass.IN, dns.rdatatype.PTR,
+                # python3
+                rrset = dns.rrset.from_text(suffix, TTL,
+                        dns.rdataclass.IN, dns.rdatatype.TXT,
                         rdata)
-            except AttributeError:
-                # dnspython2
-                rrset = dns.rrset.from_text(query.name, TTL,
-                        dns.rdataclass.IN, dns.rdatatype.PTR,
-                        rdata.encode("idna"))
-            res.answer.append(rrset)
-
-            if SERVE_TXT:
-                # additional section
-                tld = query.name.split(2)[-1].to_text(omit_final_dot=True)
-                rdata = '"see: http://en.wikipedia.org/wiki/.{}"'.format(tld)
-                # https://github.com/rthalley/dnspython/issues/44
-                try:
-                    # python3
-                    rrset = dns.rrset.from_text(suffix, TTL,
-                            dns.rdataclass.IN, dns.rdatatype.TXT,
-                            rdata)
-                except:
-                    # python2
-                    rrset = dns.rrset.from_text(suffix, TTL,
-                            dns.rdataclass.IN, dns.rdatatype.TXT,
-                            rdata.encode("latin1"))
-                res.additional.append(rrset)
+            except Exception:
+                # python2
+                rrset = dns.rrset.from_text(suffix, TTL,
+                        dns.rdataclass.IN, dns.rdatatype.TXT,
+                        rdata.encode("latin1"))
+            res.additional.append(rrset)
 
     return res
@@ -0,0 +1,35 @@
+"""
+Test helpers using async def syntax, which needs python 3.5 and up.
+"""
+
+import asyncio
+
+import dns.message
+
+
+class AsyncResolver(object):
+    """
+    Resolver that answers every query with an empty NOERROR response, after
+    sleeping concurrently with the other queries.
+    """
+
+    delay = 0.1  # seconds to sleep per query
+
+    @staticmethod
+    def query(msg):
+        raise AssertionError("query() used instead of query_async()")
+
+    @classmethod
+    async def query_async(cls, msg):
+        await asyncio.sleep(cls.delay)
+        return dns.message.make_response(msg)
+
+
+class HangingResolver(AsyncResolver):
+    """
+    Resolver whose coroutines never finish.
+    """
+
+    @classmethod
+    async def query_async(cls, msg):
+        await asyncio.Event().wait()
@@ -0,0 +1,68 @@
+# -:- coding: utf-8 -:-
+from __future__ import absolute_import
+
+import unittest
+
+from resolvers import _nametable
+
+
+class NameTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = _nametable.NameTable([
+            ("co.uk", 1),
+            ("uk", 2),
+            ("a.co.uk", 3),
+            ("co-op.uk", 4),
+            (u"xn--p1ai", 5),
+            (u"рф", 6),
+            ("CO.uk", 7),
+        ])
+
+
+    def test_get(self):
+        """
+        Test if names are found case-insensitively, and the last value wins.
+        """
+        self.assertEqual(self.table.get("uk"), 2)
+        self.assertEqual(self.table.get("Co.Uk"), 7)
+        self.assertEqual(self.table.get(u"рф"), 6)
+        self.assertIsNone(self.table.get("b.co.uk"))
+        self.assertIsNone(self.table.get("unknown"))
+        self.assertEqual(len(self.table), 6)
+
+
+    def test_order(self):
+        """
+        Test if names come out label by label from the right.
+        """
+        self.assertEqual([name for name, value in self.table],
+                         ["uk", "co.uk", "a.co.uk", "co-op.uk", u"xn--p1ai", u"рф"])
+
+
+    def test_find(self):
+        """
+        Test if names are found by key, and keys of children derived.
+        """
+        key = self.table.key(["uk", "co"])
+        i = self.table.find(key)
+        self.assertEqual(self.table.name(i), "co.uk")
+        self.assertEqual(self.table.value(i), 7)
+        self.assertIsNone(self.table.key(["uk", "unknown"]))
+
+        child = self.table.child(key, "b")
+        self.assertIsNone(child)
+        child = self.table.child(key, "a")
+        self.assertEqual(self.table.name(self.table.find(child)), "a.co.uk")
+        child = self.table.child(key, "uk")
+        self.assertIsNone(self.table.find(child))
+
+
+    def test_large(self):
+        """
+        Test if many labels get wider label IDs.
+        """
+        table = _nametable.NameTable(("{}.test".format(i), i % 256) for i in range(1000))
+        self.assertEqual(table.key(["test"]).typecode, "H")
+        for i in range(0, 1000, 7):
+            self.assertEqual(table.get("{}.test".format(i)), i % 256)
@@ -1,8 +1,13 @@
+# -:- coding: utf-8 -:-
 from __future__ import absolute_import
 
+import io
 import unittest
 import dns.opcode
+import dns.rcode
 import dns.message
+import dns.name
+import dns.rdatatype
 from textwrap import dedent
 import resolvers.publicsuffix
 import argparse
@@ -10,6 +15,11 @@ import argparse
 
 class PublicSuffixTest(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        resolvers.publicsuffix.init()
+
+
     def setUp(self):
         pass
 
@@ -21,7 +31,7 @@ class PublicSuffixTest(unittest.TestCase):
         mr = resolvers.publicsuffix.query(mq)
 
         if a:
-            a = dedent(a).strip()
+            a = dedent(a).strip().format(serial=resolvers.publicsuffix.SERIAL)
             ma = dns.message.from_text(a)
             try:
                 self.assertEqual(mr, ma)
@@ -110,7 +120,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 101
             opcode QUERY
             rcode NOERROR
-            flags QR RD
+            flags QR AA RD
             ;QUESTION
             test.com. IN PTR
             ;ANSWER
@@ -229,7 +239,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 101
             opcode QUERY
             rcode NOERROR
-            flags QR
+            flags QR AA
             ;QUESTION
             test.com. IN PTR
             ;ANSWER
@@ -248,7 +258,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 101
             opcode QUERY
             rcode NOERROR
-            flags QR
+            flags QR AA
             ;QUESTION
             test.com. IN ANY
             ;ANSWER
@@ -259,7 +269,7 @@ class PublicSuffixTest(unittest.TestCase):
 
     def test_query_non_any_ptr(self):
         """
-        Query for anything other than PTR or ANY should give NXDOMAIN.
+        Query for anything other than PTR or ANY should give NODATA with SOA.
         """
         q = """
             id 101
@@ -271,10 +281,12 @@ class PublicSuffixTest(unittest.TestCase):
         a = """
             id 101
             opcode QUERY
-            rcode NXDOMAIN
-            flags QR
+            rcode NOERROR
+            flags QR AA
             ;QUESTION
             test.com. IN A
+            ;AUTHORITY
+            . 3600 IN SOA localhost. hostmaster. {serial} 3600 600 86400 3600
             """
         self.query(q, a)
 
@@ -288,14 +300,127 @@ class PublicSuffixTest(unittest.TestCase):
         a = """
             id 101
             opcode QUERY
-            rcode NXDOMAIN
-            flags QR
+            rcode NOERROR
+            flags QR AA
             ;QUESTION
             test.com. IN CNAME
+            ;AUTHORITY
+            . 3600 IN SOA localhost. hostmaster. {serial} 3600 600 86400 3600
             """
         self.query(q, a)
 
 
+    def test_query_origin(self):
+        """
+        Query for the origin itself should give its SOA and NS records.
+        """
+        q = """
+            id 101
+            opcode QUERY
+            flags RA
+            ;QUESTION
+            . IN SOA
+            """
+        a = """
+            id 101
+            opcode QUERY
+            rcode NOERROR
+            flags QR AA
+            ;QUESTION
+            . IN SOA
+            ;ANSWER
+            . 14400 IN SOA localhost. hostmaster. {serial} 3600 600 86400 3600
+            """
+        self.query(q, a)
+
+        q = """
+            id 101
+            opcode QUERY
+            flags RA
+            ;QUESTION
+            . IN NS
+            """
+        a = """
+            id 101
+            opcode QUERY
+            rcode NOERROR
+            flags QR AA
+            ;QUESTION
+            . IN NS
+            ;ANSWER
+            . 14400 IN NS localhost.
+            """
+        self.query(q, a)
+
+        q = """
+            id 101
+            opcode QUERY
+            flags RA
+            ;QUESTION
+            . IN PTR
+            """
+        a = """
+            id 101
+            opcode QUERY
+            rcode NOERROR
+            flags QR AA
+            ;QUESTION
+            . IN PTR
+            ;AUTHORITY
+            . 3600 IN SOA localhost. hostmaster. {serial} 3600 600 86400 3600
+            """
+        self.query(q, a)
+
+
+    def test_config_origin(self):
+        """
+        Test if names outside the configured origin are refused.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--origin", default=".")
+        parser = resolvers.publicsuffix.configure_parser(parser)
+
+        try:
+            args = parser.parse_args(["--origin", "_tldns.test.invalid.",
+                                      "--negttl", "300"])
+            args.func(args)
+            resolvers.publicsuffix.build_origin()
+
+            q = """
+                id 101
+                opcode QUERY
+                flags RA
+                ;QUESTION
+                test.com.other.invalid. IN PTR
+                """
+            r = self.query(q)
+            self.assertEqual(r.rcode(), dns.rcode.REFUSED)
+
+            q = """
+                id 101
+                opcode QUERY
+                flags RA
+                ;QUESTION
+                test.com._tldns.test.invalid. IN AAAA
+                """
+            a = """
+                id 101
+                opcode QUERY
+                rcode NOERROR
+                flags QR AA
+                ;QUESTION
+                test.com._tldns.test.invalid. IN AAAA
+                ;AUTHORITY
+                _tldns.test.invalid. 300 IN SOA localhost. hostmaster._tldns.test.invalid. {serial} 3600 600 86400 300
+                """
+            self.query(q, a)
+
+        finally:
+            args = parser.parse_args([])
+            args.func(args)
+            resolvers.publicsuffix.build_origin()
+
+
     def test_query_nl(self):
         """
         Test question .nl domain. 
@@ -312,7 +437,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             test.nl. IN PTR
             ;ANSWER
@@ -331,7 +456,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             foo.test.nl. IN PTR
             ;ANSWER
@@ -350,7 +475,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             bar.foo.test.nl. IN PTR
             ;ANSWER
@@ -375,7 +500,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             test.co.uk. IN PTR
             ;ANSWER
@@ -394,7 +519,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             foo.test.co.uk. IN PTR
             ;ANSWER
@@ -413,7 +538,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             bar.foo.test.co.uk. IN PTR
             ;ANSWER
@@ -438,7 +563,7 @@ class PublicSuffixTest(unittest.TestCase):
             id 102
             opcode QUERY
             rcode NOERROR
-            flags QR 
+            flags QR AA 
             ;QUESTION
             test.co.uk. IN PTR
             ;ANSWER
@@ -446,3 +571,132 @@ class PublicSuffixTest(unittest.TestCase):
             """
         self.query(q, a)
 
+
+
+    def test_query_batch(self):
+        """
+        Test if a batch gets the same answers, looking up each name once.
+        """
+        names = ["www.test.co.uk.", "test.nl.", "WWW.test.co.uk.", "www.test.co.uk."]
+        msgs = [dns.message.make_query(name, "PTR") for name in names]
+
+        looked_up = []
+        old = resolvers.publicsuffix.psl.get_public_suffix
+
+        def counting(name):
+            looked_up.append(name)
+            return old(name)
+
+        try:
+            resolvers.publicsuffix.psl.get_public_suffix = counting
+            answers = resolvers.publicsuffix.query_batch(msgs)
+        finally:
+            resolvers.publicsuffix.psl.get_public_suffix = old
+
+        self.assertEqual(answers, [resolvers.publicsuffix.query(msg) for msg in msgs])
+        self.assertEqual(len(looked_up), 3)
+
+
+    def test_lookup_fail(self):
+        """
+        Test if failed lookups give SERVFAIL, but interrupts are not caught.
+        """
+        def failing(name):
+            raise ValueError(name)
+
+        def interrupted(name):
+            raise KeyboardInterrupt()
+
+        q = dns.message.make_query("www.test.co.uk.", "PTR")
+        r = resolvers.publicsuffix.query(q, failing)
+        self.assertEqual(r.rcode(), dns.rcode.SERVFAIL)
+        self.assertRaises(KeyboardInterrupt, resolvers.publicsuffix.query, q, interrupted)
+
+
+    def test_list_serial(self):
+        """
+        Test if the serial follows the list version, or else the file time.
+        """
+        serial = resolvers.publicsuffix.list_serial("2018-03-29_10-19-49_UTC", 1234.5)
+        self.assertEqual(serial, 1522318789)
+        self.assertEqual(resolvers.publicsuffix.list_serial(None, 1234.5), 1234)
+        self.assertEqual(resolvers.publicsuffix.list_serial("bogus", 1234.5), 1234)
+
+
+    def test_zone(self):
+        """
+        Test if the zone holds the rules, apart from the names below the origin.
+        """
+        origin = resolvers.publicsuffix.ORIGIN
+        apex = dns.name.from_text(resolvers.publicsuffix.RULES, origin)
+        rrsets = resolvers.publicsuffix.zone()
+
+        self.assertEqual(rrsets[0].name, apex)
+        self.assertEqual(rrsets[0][0], resolvers.publicsuffix.SOA[0])
+        self.assertEqual(rrsets[0][0].serial, resolvers.publicsuffix.SERIAL)
+        self.assertEqual(rrsets[1].name, apex)
+        self.assertEqual(rrsets[1][0], resolvers.publicsuffix.NS[0])
+
+        names = [rrset.name for rrset in rrsets[2:]]
+        self.assertEqual(len(names), len(set(names)))
+        for rrset in rrsets[2:]:
+            self.assertEqual(rrset.rdtype, dns.rdatatype.TXT)
+            # nothing a recursor loading the zone could take for our answers
+            self.assertTrue(rrset.name.is_subdomain(apex))
+            self.assertFalse(rrset.name.is_wild())
+
+        rules = dict((rrset.name.relativize(apex).to_text(),
+                      sorted(rdata.strings[0].decode("ascii") for rdata in rrset))
+                     for rrset in rrsets[2:])
+        self.assertEqual(rules["co.uk"], ["co.uk"])
+        self.assertEqual(rules["ck"], ["*.ck"])
+        self.assertEqual(rules["www.ck"], ["!www.ck"])
+        self.assertEqual(rules["xn--p1ai"], ["xn--p1ai"])
+
+
+    def test_zone_rules(self):
+        """
+        Test if the list rebuilt from the zone gives the same suffixes.
+        """
+        psl = resolvers.publicsuffix.psl
+        lines = [rdata.strings[0].decode("ascii") + "\n"
+                 for rrset in resolvers.publicsuffix.zone()[2:] for rdata in rrset]
+        rebuilt = resolvers.publicsuffix.SuffixList(lines)
+
+        names = [name.replace("*", "w") for name, kind in psl.rules]
+        names = [name for name in names if all(ord(c) < 128 for c in name)]
+        self.assertTrue(len(names) > 5000)
+        for name in names:
+            for prefix in ("", "a.", "www.x.y."):
+                self.assertEqual(rebuilt.get_public_suffix(prefix + name),
+                                 psl.get_public_suffix(prefix + name), prefix + name)
+
+
+class SuffixListTest(unittest.TestCase):
+
+    def test_same_as_library(self):
+        """
+        Test if the compact list gives the same suffixes as the library, below every rule.
+        """
+        import publicsuffix
+
+        path = resolvers.publicsuffix.list_file()
+        with io.open(path, encoding="utf-8") as f:
+            library = publicsuffix.PublicSuffixList(f)
+        with io.open(path, encoding="utf-8") as f:
+            compact = resolvers.publicsuffix.SuffixList(f)
+
+        names = ["", "com", "test.com", "www.test.com", "WWW.Test.COM", "example.com.",
+                 "unknown", "a.unknown", u"test.рф"]
+        with io.open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("//"):
+                    rule = line.split()[0].lstrip("!")
+                    # both the wildcard label itself, and a name it matches
+                    for name in set([rule, rule.replace("*", "w")]):
+                        names.extend(prefix + name for prefix in ("", "a.", "b.a.", "www.x.y."))
+
+        self.assertTrue(len(names) > 30000)
+        for name in names:
+            self.assertEqual(compact.get_public_suffix(name), library.get_public_suffix(name), name)
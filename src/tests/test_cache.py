@@ -0,0 +1,337 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import dns.edns
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+import cache
+
+
+def make_response(wire, ttl=60, rcode=dns.rcode.NOERROR):
+    """
+    Return response to wire format query, and its wire format.
+    """
+    q = dns.message.from_wire(wire)
+    r = dns.message.make_response(q)
+    r.set_rcode(rcode)
+    if rcode == dns.rcode.NOERROR:
+        r.answer.append(dns.rrset.from_text(q.question[0].name, ttl, dns.rdataclass.IN,
+                                            dns.rdatatype.PTR, "test.com."))
+    return r, r.to_wire()
+
+
+class QuestionKeyTest(unittest.TestCase):
+
+    def test_plain(self):
+        """
+        Test if plain queries give a key, regardless of ID and case.
+        """
+        q1 = dns.message.make_query("WwW.Test.COM.", dns.rdatatype.PTR)
+        q2 = dns.message.make_query("www.test.com.", dns.rdatatype.PTR)
+        q2.id = q1.id + 1
+
+        key1, qend1 = cache.question_key(q1.to_wire())
+        key2, qend2 = cache.question_key(q2.to_wire())
+        self.assertEqual(key1, key2)
+        self.assertEqual(qend1, len(q1.to_wire()))
+
+
+    def test_distinct(self):
+        """
+        Test if everything the response depends on ends up in the key.
+        """
+        keys = set()
+        for rdtype in (dns.rdatatype.PTR, dns.rdatatype.A):
+            for edns in (-1, 0):
+                for dnssec in (False, True):
+                    if dnssec and edns < 0:
+                        continue
+                    for rd in (0, dns.flags.RD):
+                        q = dns.message.make_query("www.test.com.", rdtype, use_edns=edns,
+                                                   want_dnssec=dnssec)
+                        q.flags = rd
+                        keys.add(cache.question_key(q.to_wire())[0])
+        self.assertEqual(len(keys), 12)
+
+
+    def test_uncacheable(self):
+        """
+        Test if anything but plain queries gives no key.
+        """
+        q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR)
+        wire = q.to_wire()
+
+        # truncated, trailing garbage, response, not a query
+        self.assertEqual(cache.question_key(wire[:-1]), (None, None))
+        self.assertEqual(cache.question_key(wire + b"\x00"), (None, None))
+        q.flags |= dns.flags.QR
+        self.assertEqual(cache.question_key(q.to_wire()), (None, None))
+        q.flags = dns.opcode.to_flags(dns.opcode.NOTIFY)
+        self.assertEqual(cache.question_key(q.to_wire()), (None, None))
+
+        # zone transfers
+        for rdtype in (dns.rdatatype.AXFR, dns.rdatatype.IXFR):
+            q = dns.message.make_query("test.com.", rdtype)
+            self.assertEqual(cache.question_key(q.to_wire()), (None, None))
+
+        # EDNS options
+        q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR, use_edns=0,
+                                   options=[dns.edns.GenericOption(10, b"12345678")])
+        self.assertEqual(cache.question_key(q.to_wire()), (None, None))
+
+        # garbage
+        self.assertEqual(cache.question_key(b"\x00" * 11), (None, None))
+        self.assertEqual(cache.question_key(wire[:12] + b"\xc0\x0c\x00\x0c\x00\x01"),
+                         (None, None))
+        self.assertEqual(cache.question_key(wire[:12] + b"\x3f\x00\x00\x0c\x00\x01"),
+                         (None, None))
+
+
+    def test_key_to_wire(self):
+        """
+        Test if queries built from keys give the same key.
+        """
+        for edns in (-1, 0):
+            q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR, use_edns=edns)
+            key = cache.question_key(q.to_wire())[0]
+            wire = cache.key_to_wire(key)
+            self.assertEqual(cache.question_key(wire)[0], key)
+            dns.message.from_wire(wire)
+
+
+class HeavyHittersTest(unittest.TestCase):
+
+    def test_top(self):
+        """
+        Test if frequent keys are found among a long tail of others.
+        """
+        hot = cache.HeavyHitters(10)
+        for i in range(10000):
+            hot.add("hot{}".format(i % 5))
+            hot.add("cold{}".format(i))
+
+        top = [key for key, count in hot.top(5)]
+        self.assertEqual(sorted(top), ["hot{}".format(i) for i in range(5)])
+        self.assertTrue(len(hot.top()) <= 10)
+
+
+    def test_save_load(self):
+        """
+        Test if the hot-set file can be read back.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "hotset")
+            hot = cache.HeavyHitters()
+            for i, name in enumerate(("www.test.com.", "www.test.nl.")):
+                q = dns.message.make_query(name, dns.rdatatype.PTR, use_edns=i - 1)
+                hot.add(cache.question_key(q.to_wire())[0], 10 - i)
+            hot.save(path)
+
+            with open(path, "a") as f:
+                f.write("bogus\n")
+
+            other = cache.HeavyHitters()
+            keys = other.load(path)
+            self.assertEqual(keys, [key for key, count in hot.top()])
+            self.assertEqual(other.top(), hot.top())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.ResponseCache(size=3)
+
+
+    def test_hit(self):
+        """
+        Test if cached responses get the ID and case of the query.
+        """
+        q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR)
+        key, wire = self.cache.lookup(q.to_wire())
+        self.assertIsNone(wire)
+
+        r, wire = make_response(q.to_wire())
+        self.cache.store(key, r, wire)
+
+        q = dns.message.make_query("WWW.test.COM.", dns.rdatatype.PTR)
+        q.id = 4321
+        key, wire = self.cache.lookup(q.to_wire())
+        r = dns.message.from_wire(wire)
+        self.assertTrue(q.is_response(r))
+        self.assertEqual(r.id, 4321)
+        self.assertEqual(r.question[0].name.labels, q.question[0].name.labels)
+        self.assertEqual(r.answer[0][0].target, dns.name.from_text("test.com."))
+
+        self.assertEqual(self.cache.hot.top(), [(key, 2)])
+
+
+    def test_uncacheable(self):
+        """
+        Test if errors and responses without TTL are not cached.
+        """
+        for i, (ttl, rcode) in enumerate(((0, dns.rcode.NOERROR),
+                                          (60, dns.rcode.SERVFAIL),
+                                          (60, dns.rcode.REFUSED))):
+            q = dns.message.make_query("www{}.test.com.".format(i), dns.rdatatype.PTR)
+            key, wire = self.cache.lookup(q.to_wire())
+            r, wire = make_response(q.to_wire(), ttl, rcode)
+            self.cache.store(key, r, wire)
+            self.assertIsNone(self.cache.lookup(q.to_wire())[1])
+            # and not prefetched again any time soon
+            self.assertEqual(self.cache.expiring([key]), [])
+
+
+    def test_expiry(self):
+        """
+        Test if entries expire, and are reported as expiring before that.
+        """
+        q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR)
+        key, wire = self.cache.lookup(q.to_wire())
+        r, wire = make_response(q.to_wire(), ttl=1)
+
+        self.cache.store(key, r, wire)
+        self.assertEqual(self.cache.expiring([key]), [])
+
+        self.cache.max_ttl = 0.01
+        self.cache.store(key, r, wire)
+        time.sleep(0.02)
+        self.assertEqual(self.cache.expiring([key]), [key])
+        self.assertIsNone(self.cache.lookup(q.to_wire())[1])
+
+
+    def test_size(self):
+        """
+        Test if the least recently used entries are evicted once full.
+        """
+        keys = []
+        for i in range(5):
+            q = dns.message.make_query("www{}.test.com.".format(i), dns.rdatatype.PTR)
+            key, wire = self.cache.lookup(q.to_wire())
+            r, wire = make_response(q.to_wire())
+            self.cache.store(key, r, wire)
+            keys.append(key)
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.expiring(keys), keys[:2])
+
+
+    def test_recently_used(self):
+        """
+        Test if entries stored again or hit are kept over newer ones.
+        """
+        def store(name):
+            q = dns.message.make_query(name, dns.rdatatype.PTR)
+            key, wire = self.cache.lookup(q.to_wire())
+            self.cache.store(key, *make_response(q.to_wire()))
+            return key
+
+        hot, a, b = store("hot.test.com."), store("a.test.com."), store("b.test.com.")
+        store("hot.test.com.")
+        c = store("c.test.com.")
+        self.assertEqual(self.cache.expiring([hot, a, b, c]), [a])
+
+        # hits count as use too
+        self.cache.lookup(dns.message.make_query("b.test.com.", dns.rdatatype.PTR).to_wire())
+        d = store("d.test.com.")
+        self.assertEqual(self.cache.expiring([hot, a, b, c, d]), [hot, a])
+
+
+    def test_generation(self):
+        """
+        Test if stale entries are dropped after a new generation.
+        """
+        q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR)
+        key, wire = self.cache.lookup(q.to_wire())
+        r, wire = make_response(q.to_wire())
+        self.cache.store(key, r, wire)
+
+        self.cache.new_generation()
+        # still served until pruned, but due for a refresh
+        self.assertIsNotNone(self.cache.lookup(q.to_wire())[1])
+        self.assertEqual(self.cache.expiring([key]), [key])
+
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertIsNone(self.cache.lookup(q.to_wire())[1])
+
+
+class WarmerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "hotset")
+        self.cache = cache.ResponseCache()
+        self.resolved = []
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def resolve(self, wire):
+        self.resolved.append(wire)
+        key = cache.question_key(wire)[0]
+        self.cache.store(key, *make_response(wire, ttl=1))
+
+
+    def test_warm_up(self):
+        """
+        Test if the cache is warmed up from the hot-set file, and saved again.
+        """
+        hot = cache.HeavyHitters()
+        q = dns.message.make_query("www.test.com.", dns.rdatatype.PTR)
+        hot.add(cache.question_key(q.to_wire())[0], 5)
+        hot.save(self.path)
+
+        warmer = cache.Warmer(self.cache, self.resolve, self.path)
+        warmer.start()
+        try:
+            self.assertTrue(warmer.warm.wait(5))
+            self.assertEqual(len(self.resolved), 1)
+            self.assertIsNotNone(self.cache.lookup(q.to_wire())[1])
+
+            # refreshed shortly before expiry
+            deadline = time.time() + 5
+            while len(self.resolved) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(len(self.resolved) >= 2)
+        finally:
+            warmer.stop()
+
+        self.assertEqual(cache.HeavyHitters().load(self.path),
+                         [cache.question_key(q.to_wire())[0]])
+
+
+    def test_reload(self):
+        """
+        Test if hot entries are refreshed upon reload, and others dropped.
+        """
+        hot = cache.question_key(dns.message.make_query("hot.test.com.", "PTR").to_wire())[0]
+        cold = cache.question_key(dns.message.make_query("cold.test.com.", "PTR").to_wire())[0]
+
+        warmer = cache.Warmer(self.cache, self.resolve, top=1)
+        warmer.start()
+        try:
+            self.assertTrue(warmer.warm.wait(5))
+            self.cache.hot.add(hot, 10)
+            self.cache.hot.add(cold, 1)
+            self.resolve(cache.key_to_wire(cold))
+
+            warmer.warm_up()
+            self.assertEqual(self.cache.expiring([hot, cold]), [cold])
+        finally:
+            warmer.stop()
@@ -0,0 +1,395 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import timeit
+import unittest
+
+import dns.message
+import dns.query
+import dns.rcode
+import dns.rrset
+
+import cache
+import junkdns
+import profiling
+
+try:
+    # python 3.5 and up
+    from tests import coroutines
+except SyntaxError:
+    coroutines = None
+
+
+class StubResolver(object):
+    """
+    Resolver that answers every query with an empty NOERROR response.
+    """
+
+    @staticmethod
+    def query(msg):
+        return dns.message.make_response(msg)
+
+
+class AnswerResolver(object):
+    """
+    Resolver that answers every query with a cacheable PTR record.
+    """
+
+    @staticmethod
+    def query(msg):
+        res = dns.message.make_response(msg)
+        res.answer.append(dns.rrset.from_text(msg.question[0].name, 60, "IN", "PTR",
+                                              "test.com."))
+        return res
+
+
+class BatchResolver(StubResolver):
+    """
+    Resolver that answers batches at once, and remembers their sizes.
+    """
+
+    batches = []
+
+    @classmethod
+    def query_batch(cls, msgs):
+        cls.batches.append(len(msgs))
+        return [cls.query(msg) for msg in msgs]
+
+
+class BrokenBatchResolver(StubResolver):
+    """
+    Resolver that answers single queries, but fails on batches.
+    """
+
+    @staticmethod
+    def query_batch(msgs):
+        raise ValueError("Broken")
+
+
+class InterruptedResolver(StubResolver):
+    """
+    Resolver interrupted while answering, as by SIGINT on the main thread.
+    """
+
+    @staticmethod
+    def query_batch(msgs):
+        raise KeyboardInterrupt()
+
+    @staticmethod
+    def query(msg):
+        raise KeyboardInterrupt()
+
+
+class ListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old = junkdns.DnsRequestHandler.resolver, junkdns.DnsRequestHandler.origin
+        junkdns.DnsRequestHandler.resolver = StubResolver
+        junkdns.DnsRequestHandler.origin = None
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        junkdns.DnsRequestHandler.resolver, junkdns.DnsRequestHandler.origin = self.old
+        shutil.rmtree(self.tmpdir)
+
+
+    def start(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return server
+
+
+    def test_listen_fds(self):
+        """
+        Test if socket activation environment is honoured and cleared.
+        """
+        os.environ["LISTEN_PID"] = str(os.getpid())
+        os.environ["LISTEN_FDS"] = "2"
+        self.assertEqual(junkdns.listen_fds(), [3, 4])
+        self.assertNotIn("LISTEN_PID", os.environ)
+        self.assertNotIn("LISTEN_FDS", os.environ)
+
+        # descriptors meant for some other process
+        os.environ["LISTEN_PID"] = str(os.getpid() + 1)
+        os.environ["LISTEN_FDS"] = "2"
+        self.assertEqual(junkdns.listen_fds(), [])
+
+        # no socket activation at all
+        self.assertEqual(junkdns.listen_fds(), [])
+
+
+    def test_unix_datagram(self):
+        """
+        Test query over Unix domain datagram socket.
+        """
+        path = os.path.join(self.tmpdir, "dns")
+        self.start(junkdns.unix_server(path, junkdns.DnsUnixDatagramServer,
+                                       junkdns.DnsUdpRequestHandler))
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.bind(os.path.join(self.tmpdir, "client"))
+        client.settimeout(5)
+
+        q = dns.message.make_query("test.com.", "PTR")
+        client.sendto(q.to_wire(), path)
+        r = dns.message.from_wire(client.recv(65535))
+        self.assertTrue(q.is_response(r))
+
+
+    def test_unix_stale_socket(self):
+        """
+        Test if a stale socket file is replaced.
+        """
+        path = os.path.join(self.tmpdir, "dns")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(path)
+        stale.close()
+
+        server = junkdns.unix_server(path, junkdns.socketserver.UnixDatagramServer,
+                                     junkdns.DnsUdpRequestHandler)
+        server.server_close()
+
+
+    def test_remove_sockets(self):
+        """
+        Test if only socket files we bound ourselves are removed on exit.
+        """
+        ours = os.path.join(self.tmpdir, "ours")
+        server = junkdns.unix_server(ours, junkdns.DnsUnixDatagramServer,
+                                     junkdns.DnsUdpRequestHandler)
+        server.server_close()
+
+        theirs = os.path.join(self.tmpdir, "theirs")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(theirs)
+        passed = junkdns.server_from_socket(sock)
+        passed.server_close()
+
+        junkdns.remove_sockets([server, passed])
+        self.assertFalse(os.path.exists(ours))
+        self.assertTrue(os.path.exists(theirs))
+
+
+    def test_unix_from_fd(self):
+        """
+        Test if pre-opened Unix domain sockets are told apart from others.
+        """
+        path = os.path.join(self.tmpdir, "dns")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        fd = os.dup(sock.fileno())
+        sock.close()
+
+        sock = junkdns.socket_from_fd(fd)
+        self.assertEqual(sock.family, socket.AF_UNIX)
+        self.assertEqual(sock.type, socket.SOCK_DGRAM)
+
+        server = junkdns.server_from_socket(sock)
+        self.assertIsInstance(server, junkdns.DnsUnixDatagramServer)
+        server.server_close()
+
+
+    def test_server_from_fd(self):
+        """
+        Test serving on a pre-opened TCP socket.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(5)
+        fd = os.dup(sock.fileno())
+        sock.close()
+
+        server = self.start(junkdns.server_from_socket(junkdns.socket_from_fd(fd)))
+        self.assertIsInstance(server, junkdns.DnsTcpServer)
+
+        q = dns.message.make_query("test.com.", "PTR")
+        r = dns.query.tcp(q, "127.0.0.1", port=server.server_address[1], timeout=5)
+        self.assertEqual(r.rcode(), dns.rcode.NOERROR)
+        self.assertTrue(q.is_response(r))
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        handler = junkdns.DnsRequestHandler
+        self.old = handler.resolver, handler.origin, handler.loop, handler.query_timeout
+        handler.origin = None
+        BatchResolver.batches = []
+
+
+    def tearDown(self):
+        handler = junkdns.DnsRequestHandler
+        if handler.loop is not None:
+            handler.loop.stop()
+        handler.resolver, handler.origin, handler.loop, handler.query_timeout = self.old
+
+
+    def queries(self, count):
+        return [dns.message.make_query("host{}.test.com.".format(i), "PTR")
+                for i in range(count)]
+
+
+    def check_responses(self, queries, responses):
+        self.assertEqual(len(responses), len(queries))
+        for q, wire in zip(queries, responses):
+            r = dns.message.from_wire(wire)
+            self.assertTrue(q.is_response(r))
+            self.assertEqual(r.rcode(), dns.rcode.NOERROR)
+
+
+    def test_batch(self):
+        """
+        Test if batches go to query_batch(), and single queries to query().
+        """
+        junkdns.DnsRequestHandler.resolver = BatchResolver
+        queries = self.queries(3)
+
+        responses = junkdns.DnsRequestHandler.respond_batch(
+            [q.to_wire() for q in queries] + [b"\x12\x34\x01"], [None] * 4)
+        self.assertIsNone(responses.pop())
+        self.check_responses(queries, responses)
+
+        junkdns.DnsRequestHandler.respond(queries[0].to_wire())
+        self.assertEqual(BatchResolver.batches, [3])
+
+
+    def test_batch_fallback(self):
+        """
+        Test if queries are answered one by one if the batch fails.
+        """
+        junkdns.DnsRequestHandler.resolver = BrokenBatchResolver
+        queries = self.queries(3)
+
+        responses = junkdns.DnsRequestHandler.respond_batch(
+            [q.to_wire() for q in queries], [None] * 3)
+        self.check_responses(queries, responses)
+
+
+    def test_profile_stages(self):
+        """
+        Test if answers from cache are reported to the profiler as their own stage.
+        """
+        handler = junkdns.DnsRequestHandler
+        old = handler.cache, handler.profiler
+        self.addCleanup(setattr, handler, "cache", old[0])
+        self.addCleanup(setattr, handler, "profiler", old[1])
+
+        handler.resolver = AnswerResolver
+        handler.cache = cache.ResponseCache()
+        handler.profiler = profiling.Profiler()
+        handler.profiler.running = True
+
+        q = self.queries(1)[0]
+        for i in range(3):
+            handler.respond(q.to_wire())
+
+        stages = handler.profiler._stages
+        self.assertEqual(stages["decode"][0], 1)
+        self.assertEqual(stages["hit"][0], 2)
+
+
+    @unittest.skipIf(coroutines is None, "needs python 3.5 and up")
+    def test_async(self):
+        """
+        Test if coroutines of a batch run concurrently on the event loop.
+        """
+        junkdns.DnsRequestHandler.resolver = coroutines.AsyncResolver
+        junkdns.DnsRequestHandler.loop = junkdns.AsyncLoop()
+        queries = self.queries(10)
+
+        start = timeit.default_timer()
+        responses = junkdns.DnsRequestHandler.respond_batch(
+            [q.to_wire() for q in queries], [None] * 10)
+        self.check_responses(queries, responses)
+        self.assertTrue(timeit.default_timer() - start < 10 * coroutines.AsyncResolver.delay)
+
+
+    @unittest.skipIf(coroutines is None, "needs python 3.5 and up")
+    def test_async_timeout(self):
+        """
+        Test if coroutines that take too long get SERVFAIL in time.
+        """
+        junkdns.DnsRequestHandler.resolver = coroutines.HangingResolver
+        junkdns.DnsRequestHandler.loop = junkdns.AsyncLoop()
+        junkdns.DnsRequestHandler.query_timeout = timeout = 0.5
+        queries = self.queries(3)
+
+        start = timeit.default_timer()
+        responses = junkdns.DnsRequestHandler.respond_batch(
+            [q.to_wire() for q in queries], [None] * 3)
+        # the timeout is for the batch as a whole, not for each query in turn
+        elapsed = timeit.default_timer() - start
+        self.assertTrue(timeout <= elapsed < len(queries) * timeout)
+        for wire in responses:
+            self.assertEqual(dns.message.from_wire(wire).rcode(), dns.rcode.SERVFAIL)
+
+
+    def test_interrupt(self):
+        """
+        Test if interrupts are not taken for resolver failures.
+        """
+        junkdns.DnsRequestHandler.resolver = InterruptedResolver
+        server = junkdns.DnsUdpServer(("127.0.0.1", 0), junkdns.DnsUdpRequestHandler)
+        self.addCleanup(server.server_close)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        for q in self.queries(2):
+            client.sendto(q.to_wire(), server.server_address)
+        self.assertRaises(KeyboardInterrupt, server.handle_request)
+
+
+    def test_udp_batch(self):
+        """
+        Test if queued UDP queries are answered as a batch.
+        """
+        junkdns.DnsRequestHandler.resolver = BatchResolver
+        server = junkdns.DnsUdpServer(("127.0.0.1", 0), junkdns.DnsUdpRequestHandler)
+        self.addCleanup(server.server_close)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.settimeout(5)
+
+        queries = self.queries(5)
+        for q in queries:
+            client.sendto(q.to_wire(), server.server_address)
+        server.handle_request()
+
+        self.check_responses(queries, [client.recv(65535) for q in queries])
+        self.assertEqual(BatchResolver.batches, [5])
+
+
+class ModuleTest(unittest.TestCase):
+
+    def test_find_modules(self):
+        """
+        Test if resolver metadata is found without importing.
+        """
+        modules = junkdns.find_modules(junkdns.RESOLVERS_PATH)
+        self.assertEqual(modules["publicsuffix"]["NAME"], "publicsuffix")
+        self.assertIn("HELP", modules["publicsuffix"])
+        self.assertIn("DESC", modules["publicsuffix"])
+        self.assertNotIn("_nametable", modules)
+
+
+    def test_load_module(self):
+        """
+        Test if a single resolver can be loaded.
+        """
+        module = junkdns.load_module(junkdns.RESOLVERS_PATH, "publicsuffix")
+        self.assertEqual(module.NAME, "publicsuffix")
+        self.assertTrue(callable(module.init))
@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import profiling
+
+
+def spin(event):
+    while not event.is_set():
+        sum(range(100))
+
+
+def idle(event):
+    event.wait()
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.profiler = profiling.Profiler(self.tmpdir, interval=0.001)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_profile(self):
+        """
+        Test if stacks of other threads are sampled and written in collapsed form.
+        """
+        event = threading.Event()
+        thread = threading.Thread(target=spin, args=(event,))
+        thread.start()
+        waiting = threading.Thread(target=idle, args=(event,))
+        waiting.start()
+
+        try:
+            self.assertTrue(self.profiler.start(0.2))
+            self.assertTrue(self.profiler.running)
+            # only one profile at a time
+            self.assertFalse(self.profiler.start(0.2))
+            self.profiler.join()
+        finally:
+            event.set()
+            thread.join()
+            waiting.join()
+
+        self.assertFalse(self.profiler.running)
+
+        collapsed, stages = self.profiler.dump()
+        with open(collapsed) as f:
+            lines = f.read().splitlines()
+
+        spinning = [line for line in lines if "spin (test_profiling.py:" in line]
+        self.assertTrue(spinning)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(int(count) > 0)
+            # we don't sample ourselves, nor threads waiting for work
+            self.assertNotIn("_run (profiling.py:", stack)
+            self.assertNotIn("idle (test_profiling.py:", stack)
+
+
+    def test_start_while_recording(self):
+        """
+        Test if a profile can be started while stage timings are being recorded.
+        """
+        results = []
+
+        def interrupted():
+            # as when SIGUSR1 arrives on the main thread in the middle of record()
+            with self.profiler._lock:
+                results.append(self.profiler.start(0.01))
+                results.append(self.profiler.start(0.01))
+
+        thread = threading.Thread(target=interrupted)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+        self.profiler.join()
+        self.assertEqual(results, [True, False])
+
+
+    def test_record(self):
+        """
+        Test if stage timings are summarised.
+        """
+        self.profiler.record(decode=0.001, resolve=0.002)
+        self.profiler.record(decode=0.003, resolve=0.004)
+
+        collapsed, stages = self.profiler.dump()
+        with open(stages) as f:
+            lines = f.read().splitlines()
+
+        decode = [line.split() for line in lines if line.startswith("decode")][0]
+        self.assertEqual(decode[1], "2")
+        self.assertEqual(float(decode[2]), 4.0)
+        self.assertEqual(float(decode[3]), 2.0)
+        self.assertEqual(float(decode[4]), 3.0)
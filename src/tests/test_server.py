@@ -0,0 +1,445 @@
+from __future__ import absolute_import
+
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import timeit
+import unittest
+
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+import cache
+import junkdns
+import resolvers.publicsuffix
+
+
+# number of concurrent clients, and queries per client
+CLIENTS = 20
+QUERIES = 25
+
+# run the mixed load test for this long; raise for a proper soak test
+SOAK_SECONDS = float(os.environ.get("JUNKDNS_SOAK_SECONDS", 1))
+
+
+class EchoResolver(object):
+    """
+    Resolver answering every query with a TXT record holding the query name.
+    """
+
+    @staticmethod
+    def query(msg):
+        res = dns.message.make_response(msg)
+        name = msg.question[0].name
+        res.answer.append(dns.rrset.from_text(name, 60, dns.rdataclass.IN,
+                                              dns.rdatatype.TXT,
+                                              '"{}"'.format(name)))
+        return res
+
+
+class LowercaseEchoResolver(object):
+    """
+    Resolver answering every query with a TXT record holding the lowercased
+    query name, which may be cached.
+    """
+
+    CACHEABLE = True
+
+    @staticmethod
+    def query(msg):
+        res = dns.message.make_response(msg)
+        name = msg.question[0].name
+        res.answer.append(dns.rrset.from_text(name, 60, dns.rdataclass.IN,
+                                              dns.rdatatype.TXT,
+                                              '"{}"'.format(name.to_text().lower())))
+        return res
+
+
+def open_fds():
+    """
+    Return number of open file descriptors, or None if we can't tell.
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def recv_exactly(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError("Connection closed after {} bytes".format(len(data)))
+        data += chunk
+    return data
+
+
+class ServerTestMixin(object):
+    """
+    Resolver agnostic tests of the UDP and TCP servers under concurrent load.
+
+    Mix in with TestCase and set resolver, and check_answer() if the default
+    validation of responses doesn't suffice.
+    """
+
+    resolver = None
+    cached = False  # answer from a response cache
+
+    def setUp(self):
+        self.threads = threading.active_count()
+        self.fds = open_fds()
+
+        handler = junkdns.DnsRequestHandler
+        self.old = handler.resolver, handler.origin, handler.cache
+        handler.resolver = self.resolver
+        handler.origin = None
+        handler.cache = None
+        if self.cached:
+            self.assertTrue(self.resolver.CACHEABLE)
+            handler.cache = cache.ResponseCache()
+
+        self.udpserver = junkdns.DnsUdpServer(("127.0.0.1", 0),
+                                              junkdns.DnsUdpRequestHandler)
+        self.tcpserver = junkdns.DnsTcpServer(("127.0.0.1", 0),
+                                              junkdns.DnsTcpRequestHandler)
+        self.servers = [threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+                        for server in (self.udpserver, self.tcpserver)]
+        for thread in self.servers:
+            thread.start()
+
+        self.udpaddr = self.udpserver.server_address
+        self.tcpaddr = self.tcpserver.server_address
+        self.errors = []
+
+
+    def tearDown(self):
+        for server in (self.udpserver, self.tcpserver):
+            server.shutdown()
+            server.server_close()
+        for thread in self.servers:
+            thread.join()
+
+        handler = junkdns.DnsRequestHandler
+        handler.resolver, handler.origin, handler.cache = self.old
+
+        # give handler threads a moment to wind down
+        deadline = time.time() + 5
+        while threading.active_count() > self.threads and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(threading.active_count(), self.threads, "threads leaked")
+        if self.fds is not None:
+            self.assertEqual(open_fds(), self.fds, "file descriptors leaked")
+
+
+    def make_query(self, i):
+        """
+        Return a query with a random ID and a name unique to i.
+        """
+        msg = dns.message.make_query("host{}.test{}.co.uk.".format(i, random.randint(0, 999)),
+                                     dns.rdatatype.PTR)
+        msg.id = random.randint(0, 65535)
+        return msg
+
+
+    def check_answer(self, q, r):
+        """
+        Check response r against query q.
+        """
+        self.assertEqual(r.id, q.id)
+        self.assertEqual(r.question, q.question)
+        self.assertTrue(q.is_response(r))
+        self.assertEqual(r.rcode(), dns.rcode.NOERROR)
+        self.assertTrue(r.answer)
+        self.assertEqual(r.answer[0].name, q.question[0].name)
+
+
+    def udp(self, q, sock=None):
+        own = sock is None
+        if own:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)
+        try:
+            sock.sendto(q.to_wire(), self.udpaddr)
+            return dns.message.from_wire(sock.recv(65535))
+        finally:
+            if own:
+                sock.close()
+
+
+    def tcp(self, q, chunk=None, delay=0):
+        """
+        Send query over a fresh TCP connection, chunk bytes at a time.
+        """
+        sock = socket.create_connection(self.tcpaddr, timeout=5)
+        try:
+            wire = q.to_wire()
+            wire = struct.pack("!H", len(wire)) + wire
+            chunk = chunk or len(wire)
+            for i in range(0, len(wire), chunk):
+                sock.sendall(wire[i:i + chunk])
+                if delay:
+                    time.sleep(delay)
+            length = struct.unpack("!H", recv_exactly(sock, 2))[0]
+            return dns.message.from_wire(recv_exactly(sock, length))
+        finally:
+            sock.close()
+
+
+    def run_clients(self, target, clients=CLIENTS):
+        """
+        Run target(i) in concurrent threads, and collect their exceptions.
+        """
+        def wrapper(i):
+            try:
+                target(i)
+            except Exception as e:
+                self.errors.append(e)
+
+        threads = [threading.Thread(target=wrapper, args=(i,)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+
+    def test_udp_concurrent(self):
+        """
+        Test many concurrent UDP clients.
+        """
+        def client(i):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)
+            try:
+                for j in range(QUERIES):
+                    q = self.make_query(i * QUERIES + j)
+                    self.check_answer(q, self.udp(q, sock))
+            finally:
+                sock.close()
+
+        self.run_clients(client)
+
+
+    def test_tcp_concurrent(self):
+        """
+        Test many concurrent TCP clients.
+        """
+        def client(i):
+            for j in range(QUERIES):
+                q = self.make_query(i * QUERIES + j)
+                self.check_answer(q, self.tcp(q))
+
+        self.run_clients(client)
+
+
+    def test_tcp_partial(self):
+        """
+        Test TCP clients sending queries in small pieces.
+        """
+        def client(i):
+            for chunk in (1, 2, 3, 7):
+                q = self.make_query(i * 10 + chunk)
+                self.check_answer(q, self.tcp(q, chunk=chunk, delay=0.001))
+
+        self.run_clients(client)
+
+
+    def test_tcp_slow(self):
+        """
+        Test if slow TCP clients don't hold up others.
+        """
+        delay = 0.05
+
+        def slow(i):
+            q = self.make_query(i)
+            self.check_answer(q, self.tcp(q, chunk=1, delay=delay))
+
+        slowpokes = [threading.Thread(target=slow, args=(i,)) for i in range(5)]
+        for thread in slowpokes:
+            thread.start()
+
+        try:
+            start = timeit.default_timer()
+            for i in range(10):
+                q = self.make_query(100 + i)
+                self.check_answer(q, self.tcp(q))
+            # done before a single slow client is done sending, byte by byte
+            self.assertTrue(timeit.default_timer() - start <
+                            delay * (2 + len(self.make_query(0).to_wire())))
+        finally:
+            for thread in slowpokes:
+                thread.join()
+
+
+    def test_tcp_idle(self):
+        """
+        Test if connections closed early or left idle don't upset the server.
+        """
+        handler = junkdns.DnsTcpRequestHandler
+        old, handler.timeout = handler.timeout, 0.1
+
+        try:
+            # closed after half a length prefix
+            sock = socket.create_connection(self.tcpaddr, timeout=5)
+            sock.sendall(b"\x00")
+            sock.close()
+
+            # closed halfway through a query
+            sock = socket.create_connection(self.tcpaddr, timeout=5)
+            sock.sendall(b"\x00\x20\x12\x34")
+            sock.close()
+
+            # idle until the server gives up
+            sock = socket.create_connection(self.tcpaddr, timeout=5)
+            self.assertEqual(sock.recv(1), b"")
+            sock.close()
+        finally:
+            handler.timeout = old
+
+        q = self.make_query(1)
+        self.check_answer(q, self.tcp(q))
+
+
+    def test_malformed(self):
+        """
+        Test if malformed queries give FORMERR, or are dropped if hopeless.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.5)
+
+        try:
+            # valid header, garbage question
+            sock.sendto(b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\xff\xff", self.udpaddr)
+            r = dns.message.from_wire(sock.recv(65535))
+            self.assertEqual(r.id, 0x1234)
+            self.assertEqual(r.rcode(), dns.rcode.FORMERR)
+
+            # too short to answer, and responses are never answered
+            sock.sendto(b"\x12\x34\x01", self.udpaddr)
+            sock.sendto(b"\x12\x34\x81\x00\x00\x01\x00\x00\x00\x00\x00\x00\xff\xff", self.udpaddr)
+            self.assertRaises(socket.timeout, sock.recv, 65535)
+        finally:
+            sock.close()
+
+        # garbage over TCP
+        sock = socket.create_connection(self.tcpaddr, timeout=5)
+        try:
+            garbage = b"\x43\x21\x01\x00" + os.urandom(20)
+            sock.sendall(struct.pack("!H", len(garbage)) + garbage)
+            length = struct.unpack("!H", recv_exactly(sock, 2))[0]
+            r = dns.message.from_wire(recv_exactly(sock, length))
+            self.assertEqual(r.id, 0x4321)
+            self.assertEqual(r.rcode(), dns.rcode.FORMERR)
+        finally:
+            sock.close()
+
+        # server still in business
+        q = self.make_query(1)
+        self.check_answer(q, self.udp(q))
+        self.check_answer(q, self.tcp(q))
+
+
+    def test_repeat(self):
+        """
+        Test if repeated questions get their own ID and name case.
+        """
+        q = self.make_query(1)
+        name = q.question[0].name.to_text()
+
+        def client(i):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)
+            try:
+                for j in range(QUERIES):
+                    mixed = "".join(c.upper() if random.random() < 0.5 else c for c in name)
+                    q = dns.message.make_query(mixed, dns.rdatatype.PTR)
+                    r = self.udp(q, sock) if j % 2 else self.tcp(q)
+                    self.check_answer(q, r)
+                    self.assertEqual(r.question[0].name.labels, q.question[0].name.labels)
+            finally:
+                sock.close()
+
+        self.run_clients(client)
+
+
+    def test_soak(self):
+        """
+        Test mixed UDP, TCP and malformed traffic for SOAK_SECONDS.
+        """
+        deadline = timeit.default_timer() + SOAK_SECONDS
+
+        def client(i):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)
+            try:
+                j = 0
+                while timeit.default_timer() < deadline:
+                    q = self.make_query(i * 100000 + j)
+                    kind = j % 4
+                    if kind == 0:
+                        self.check_answer(q, self.tcp(q, chunk=random.randint(1, 16)))
+                    elif kind == 1:
+                        sock.sendto(os.urandom(random.randint(0, 11)), self.udpaddr)
+                    else:
+                        self.check_answer(q, self.udp(q, sock))
+                    j += 1
+            finally:
+                sock.close()
+
+        self.run_clients(client)
+
+
+class EchoServerTest(ServerTestMixin, unittest.TestCase):
+
+    resolver = EchoResolver
+
+
+    def check_answer(self, q, r):
+        ServerTestMixin.check_answer(self, q, r)
+        self.assertEqual(r.answer[0][0].strings[0].decode("ascii"),
+                         q.question[0].name.to_text())
+
+
+class CachedEchoServerTest(ServerTestMixin, unittest.TestCase):
+
+    resolver = LowercaseEchoResolver
+    cached = True
+
+
+    def check_answer(self, q, r):
+        ServerTestMixin.check_answer(self, q, r)
+        self.assertEqual(r.answer[0][0].strings[0].decode("ascii"),
+                         q.question[0].name.to_text().lower())
+
+
+class PublicSuffixServerTest(ServerTestMixin, unittest.TestCase):
+
+    resolver = resolvers.publicsuffix
+
+    @classmethod
+    def setUpClass(cls):
+        resolvers.publicsuffix.init()
+
+
+    def check_answer(self, q, r):
+        ServerTestMixin.check_answer(self, q, r)
+        self.assertEqual(r.answer[0][0].target, q.question[0].name.parent())
+        # the same for every client, whatever the case of the name they asked
+        tld = q.question[0].name.labels[-2].decode("ascii").lower()
+        self.assertEqual(r.additional[0][0].strings[0].decode("ascii"),
+                         "see: http://en.wikipedia.org/wiki/.{}".format(tld))
+
+
+class CachedPublicSuffixServerTest(PublicSuffixServerTest):
+
+    cached = True
@@ -0,0 +1,239 @@
+from __future__ import absolute_import
+
+import threading
+import unittest
+
+import dns.message
+import dns.query
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+import junkdns
+import transfer
+
+
+ORIGIN = "example."
+
+
+def make_zone(serial, names):
+    """
+    Return a zone of rrsets with given SOA serial, and an A record per name.
+    """
+    rrsets = [dns.rrset.from_text(ORIGIN, 300, dns.rdataclass.IN, dns.rdatatype.SOA,
+                                  "ns.example. hostmaster.example. {} 3600 600 86400 300".format(serial))]
+    for i, name in enumerate(names):
+        rrsets.append(dns.rrset.from_text(name + "." + ORIGIN, 300, dns.rdataclass.IN,
+                                          dns.rdatatype.A, "192.0.2.{}".format(i)))
+    return rrsets
+
+
+def records(messages):
+    """
+    Return the answer records in a sequence of messages, as (name, type) pairs.
+    """
+    return [(rrset.name.to_text(), rrset.rdtype) for msg in messages for rrset in msg.answer]
+
+
+def decode(first, chunks, qid):
+    """
+    Return the messages of a transfer, from its first message and Chunks.
+    """
+    messages = [first]
+    for chunk in chunks.stream(qid):
+        while chunk:
+            length = (ord(chunk[0:1]) << 8) + ord(chunk[1:2])
+            messages.append(dns.message.from_wire(chunk[2:2 + length], one_rr_per_rrset=True))
+            chunk = chunk[2 + length:]
+    return messages
+
+
+class TransfersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transfers = transfer.Transfers(history=2)
+        self.transfers.update(make_zone(1, ["a", "b", "c"]))
+
+
+    def query(self, rdtype, serial=None, name=ORIGIN):
+        q = dns.message.make_query(name, rdtype)
+        if serial is not None:
+            q.authority.append(make_zone(serial, [])[0])
+        return q
+
+
+    def test_is_transfer_query(self):
+        """
+        Test if transfer queries are told apart from others without decoding.
+        """
+        self.assertTrue(transfer.is_transfer_query(self.query("AXFR").to_wire()))
+        self.assertTrue(transfer.is_transfer_query(self.query("IXFR", 1).to_wire()))
+        self.assertFalse(transfer.is_transfer_query(self.query("SOA").to_wire()))
+        self.assertFalse(transfer.is_transfer_query(self.query("AXFR").to_wire()[:-3]))
+        self.assertFalse(transfer.is_transfer_query(b"\x12\x34"))
+
+
+    def test_axfr(self):
+        """
+        Test if a full transfer starts and ends with the SOA, with all records in between.
+        """
+        transfer.MESSAGE_SIZE, old = 64, transfer.MESSAGE_SIZE
+        try:
+            self.transfers.update(make_zone(2, ["a", "b", "c", "d"]))
+        finally:
+            transfer.MESSAGE_SIZE = old
+
+        q = self.query("AXFR")
+        first, chunks = self.transfers.respond(q)
+        messages = decode(first, chunks, q.id)
+
+        self.assertEqual(first.question, q.question)
+        self.assertTrue(len(messages) > 2)
+        for msg in messages:
+            self.assertTrue(q.is_response(msg) or msg.id == q.id)
+        self.assertEqual(records(messages),
+                         [("example.", dns.rdatatype.SOA)] +
+                         [(name + ".example.", dns.rdatatype.A) for name in "abcd"] +
+                         [("example.", dns.rdatatype.SOA)])
+
+
+    def test_ixfr(self):
+        """
+        Test if incremental transfers hold the changes since the client's version.
+        """
+        self.transfers.update(make_zone(2, ["a", "b", "d"]))
+        self.transfers.update(make_zone(3, ["b", "d", "e"]))
+
+        q = self.query("IXFR", 1)
+        first, chunks = self.transfers.respond(q)
+        self.assertEqual(records(decode(first, chunks, q.id)), [
+            ("example.", dns.rdatatype.SOA),
+            # 1 to 2
+            ("example.", dns.rdatatype.SOA), ("c.example.", dns.rdatatype.A),
+            ("example.", dns.rdatatype.SOA), ("d.example.", dns.rdatatype.A),
+            # 2 to 3
+            ("example.", dns.rdatatype.SOA), ("a.example.", dns.rdatatype.A),
+            ("b.example.", dns.rdatatype.A), ("d.example.", dns.rdatatype.A),
+            ("example.", dns.rdatatype.SOA), ("b.example.", dns.rdatatype.A),
+            ("d.example.", dns.rdatatype.A), ("e.example.", dns.rdatatype.A),
+            ("example.", dns.rdatatype.SOA),
+        ])
+
+        # records that changed address are deleted and added again
+        q = self.query("IXFR", 2)
+        first, chunks = self.transfers.respond(q)
+        self.assertEqual(len(records(decode(first, chunks, q.id))), 10)
+
+
+    def test_ixfr_fallback(self):
+        """
+        Test if up to date and unknown versions get just the SOA, or everything.
+        """
+        q = self.query("IXFR", 1)
+        first, chunks = self.transfers.respond(q)
+        self.assertIsNone(chunks)
+        self.assertEqual(records([first]), [("example.", dns.rdatatype.SOA)])
+
+        # older than the history goes back
+        for serial in (2, 3, 4):
+            self.transfers.update(make_zone(serial, ["a", "b", "c", str(serial)]))
+        first, chunks = self.transfers.respond(self.query("IXFR", 1))
+        self.assertIs(chunks, self.transfers.version.axfr)
+        first, chunks = self.transfers.respond(self.query("IXFR", 2))
+        self.assertIsNot(chunks, self.transfers.version.axfr)
+
+
+    def test_udp(self):
+        """
+        Test if datagrams get the SOA for IXFR, but no full transfers.
+        """
+        first, chunks = self.transfers.respond(self.query("IXFR", 0), tcp=False)
+        self.assertIsNone(chunks)
+        self.assertEqual(records([first]), [("example.", dns.rdatatype.SOA)])
+
+        first, chunks = self.transfers.respond(self.query("AXFR"), tcp=False)
+        self.assertIsNone(chunks)
+        self.assertEqual(first.rcode(), dns.rcode.REFUSED)
+
+
+    def test_refused(self):
+        """
+        Test if transfers of other zones are refused.
+        """
+        for name in ("other.", "a.example."):
+            first, chunks = self.transfers.respond(self.query("AXFR", name=name))
+            self.assertIsNone(chunks)
+            self.assertEqual(first.rcode(), dns.rcode.REFUSED)
+
+
+    def test_unchanged(self):
+        """
+        Test if updates without a new serial keep the current version.
+        """
+        version = self.transfers.version
+        self.transfers.update(make_zone(1, ["a", "b", "c"]))
+        self.assertIs(self.transfers.version, version)
+
+        self.transfers.update(make_zone(1, ["a", "b"]))
+        self.assertIsNot(self.transfers.version, version)
+        self.assertEqual(self.transfers.version.incremental, {})
+
+
+class TransferServerTest(unittest.TestCase):
+
+    def setUp(self):
+        handler = junkdns.DnsRequestHandler
+        self.old = handler.resolver, handler.origin, handler.transfers
+        handler.origin = None
+        handler.transfers = transfer.Transfers()
+        handler.transfers.update(make_zone(1, ["a", "b", "c"]))
+
+        self.server = junkdns.DnsTcpServer(("127.0.0.1", 0), junkdns.DnsTcpRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        handler = junkdns.DnsRequestHandler
+        handler.resolver, handler.origin, handler.transfers = self.old
+
+
+    def test_axfr(self):
+        """
+        Test full transfer over TCP.
+        """
+        messages = list(dns.query.xfr("127.0.0.1", ORIGIN, port=self.port, timeout=5,
+                                      lifetime=5, relativize=False))
+        self.assertEqual(len(records(messages)), 5)
+
+
+    def test_origin(self):
+        """
+        Test if zones are transferred by their full name, whatever the origin.
+        """
+        junkdns.DnsRequestHandler.origin = "."
+        messages = list(dns.query.xfr("127.0.0.1", ORIGIN, port=self.port, timeout=5,
+                                      lifetime=5, relativize=False))
+        self.assertEqual(len(records(messages)), 5)
+
+        q = dns.message.make_query(ORIGIN, "IXFR")
+        q.authority.append(make_zone(1, [])[0])
+        r = dns.message.from_wire(junkdns.DnsRequestHandler.respond(q.to_wire()))
+        self.assertEqual(records([r]), [("example.", dns.rdatatype.SOA)])
+
+
+    def test_ixfr(self):
+        """
+        Test incremental transfer over TCP.
+        """
+        junkdns.DnsRequestHandler.transfers.update(make_zone(2, ["a", "b", "d"]))
+        messages = list(dns.query.xfr("127.0.0.1", ORIGIN, "IXFR", port=self.port,
+                                      timeout=5, lifetime=5, relativize=False, serial=1))
+        self.assertEqual(records(messages)[-2:], [("d.example.", dns.rdatatype.A),
+                                                  ("example.", dns.rdatatype.SOA)])
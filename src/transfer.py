@@ -0,0 +1,257 @@
+# -:- coding: utf-8 -:-
+"""
+Zone transfers (AXFR and IXFR) of resolver data sets, from precomputed wire format.
+"""
+
+from __future__ import absolute_import
+
+import io
+import logging
+import struct
+import threading
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+
+
+log = logging.getLogger(__name__)
+
+MESSAGE_SIZE = 16384  # bytes of records per transfer message, at most
+CHUNK_SIZE = 65536  # bytes of messages to send at once
+HISTORY = 10  # number of earlier versions to serve incremental transfers from
+
+TRANSFER_TYPES = (dns.rdatatype.AXFR, dns.rdatatype.IXFR)
+
+# header of a transfer message: ID, flags and section counts
+HEADER = struct.Struct("!HHHHHH")
+
+
+def is_transfer_query(data):
+    """
+    Tell whether a wire format query asks for AXFR or IXFR, without decoding it.
+    """
+    # walk the labels of the query name, which is never compressed in practice
+    pos = 12
+    while pos < len(data):
+        length = ord(data[pos:pos + 1])
+        if length & 0xC0:
+            return False
+        pos += 1 + length
+        if length == 0:
+            break
+    else:
+        return False
+
+    if pos + 2 > len(data):
+        return False
+    return struct.unpack("!H", data[pos:pos + 2])[0] in TRANSFER_TYPES
+
+
+def record_wire(rrset):
+    """
+    Return uncompressed wire format of each record in rrset.
+    """
+    owner = rrset.name.to_wire()
+    records = []
+    for rdata in rrset:
+        f = io.BytesIO()
+        rdata.to_wire(f)
+        rdata = f.getvalue()
+        records.append(owner + struct.pack("!HHIH", rrset.rdtype, rrset.rdclass,
+                                           rrset.ttl, len(rdata)) + rdata)
+    return records
+
+
+class Chunks(object):
+    """
+    A stream of records cut into transfer messages, precomputed in wire format.
+
+    Messages are packed into chunks of about CHUNK_SIZE bytes, each message
+    prefixed with its length as over TCP. Only the message IDs are left to
+    fill in when sending, so a transfer costs next to nothing to serve.
+    """
+
+    __slots__ = ("chunks", "messages")
+
+    def __init__(self, records):
+        self.chunks = []  # (wire, offsets of message IDs) tuples
+        self.messages = 0
+
+        chunk, ids = [], []
+        size = 0
+        for message in self._messages(records):
+            if size and size + len(message) > CHUNK_SIZE:
+                self.chunks.append((b"".join(chunk), ids))
+                chunk, ids, size = [], [], 0
+            ids.append(size + 2)
+            chunk.append(message)
+            size += len(message)
+            self.messages += 1
+        if chunk:
+            self.chunks.append((b"".join(chunk), ids))
+
+    @staticmethod
+    def _messages(records):
+        batch, size = [], 0
+        for record in records:
+            if batch and size + len(record) > MESSAGE_SIZE:
+                yield Chunks._message(batch)
+                batch, size = [], 0
+            batch.append(record)
+            size += len(record)
+        if batch:
+            yield Chunks._message(batch)
+
+    @staticmethod
+    def _message(records):
+        # subsequent messages of a transfer may leave out the question
+        header = HEADER.pack(0, dns.flags.QR | dns.flags.AA, 0, len(records), 0, 0)
+        message = header + b"".join(records)
+        return struct.pack("!H", len(message)) + message
+
+    def stream(self, qid):
+        """
+        Yield the chunks, with the messages stamped with the query's ID.
+        """
+        qid = struct.pack("!H", qid)
+        for wire, ids in self.chunks:
+            chunk = bytearray(wire)
+            for offset in ids:
+                chunk[offset:offset + 2] = qid
+            yield bytes(chunk)
+
+
+class Version(object):
+    """
+    One version of a zone: its SOA, its records, and precomputed transfers.
+    """
+
+    def __init__(self, rrsets):
+        self.soa = rrsets[0]
+        if self.soa.rdtype != dns.rdatatype.SOA:
+            raise ValueError("Zone should start with SOA, not {}".format(self.soa))
+
+        self.origin = self.soa.name
+        self.serial = self.soa[0].serial
+        self.soa_wire = record_wire(self.soa)[0]
+
+        # records other than the SOA, in order, to compare with the next version
+        self.records = [record for rrset in rrsets[1:] for record in record_wire(rrset)]
+        self.axfr = Chunks(self.records + [self.soa_wire])
+        self.incremental = dict()  # serial -> Chunks, to bring that version up to date
+
+
+class Transfers(object):
+    """
+    Serve the data set of a resolver as a zone, over AXFR and IXFR.
+
+    Each time the zone is updated, the differences with the previous version
+    are computed, and incremental transfers from each of the last HISTORY
+    versions are precomputed, along with a full transfer.
+
+    Clients that are up to date, or ask over UDP, get just the SOA. Those
+    asking for an incremental transfer from an unknown version get the full
+    zone, as RFC 1995 allows. Full transfers are only served over TCP.
+    """
+
+    def __init__(self, history=HISTORY):
+        self.history = history
+        self.version = None
+
+        self._diffs = []  # (old serial, old SOA, deleted, new SOA, added), oldest first
+        self._lock = threading.Lock()
+
+    def update(self, rrsets):
+        """
+        Make rrsets the current version of the zone; the first should be its SOA.
+        """
+        new = Version(rrsets)
+
+        with self._lock:
+            old = self.version
+            diffs = self._diffs
+
+            if old is None or old.origin != new.origin:
+                diffs = []
+            elif old.serial == new.serial:
+                if old.records == new.records:
+                    log.info("Zone unchanged at serial %d", new.serial)
+                    return
+                log.warning("Zone changed without a new serial %d; "
+                            "dropping incremental transfers", new.serial)
+                diffs = []
+            else:
+                current = set(new.records)
+                previous = set(old.records)
+                deleted = [record for record in old.records if record not in current]
+                added = [record for record in new.records if record not in previous]
+                diffs = diffs + [(old.serial, old.soa_wire, deleted, new.soa_wire, added)]
+                diffs = diffs[-self.history:]
+                log.info("Zone serial %d to %d: %d records deleted, %d added",
+                         old.serial, new.serial, len(deleted), len(added))
+
+            # changes since each older version, ending on the new SOA again
+            records = [new.soa_wire]
+            for serial, old_soa, deleted, new_soa, added in reversed(diffs):
+                records[:0] = [old_soa] + deleted + [new_soa] + added
+                new.incremental[serial] = Chunks(records)
+
+            self.version = new
+            self._diffs = diffs
+
+    def is_transfer(self, msg):
+        return len(msg.question) == 1 and msg.question[0].rdtype in TRANSFER_TYPES
+
+    def respond(self, msg, tcp=True):
+        """
+        Return first response message to a transfer query, and further Chunks.
+
+        Names in the query should be absolute, not relative to some origin.
+
+        The first message holds the question, and at least the SOA unless
+        the query is refused. The chunks, if any, hold the rest of the
+        transfer, and are None over UDP.
+        """
+        version = self.version
+        res = dns.message.make_response(msg)
+        question = msg.question[0]
+
+        if version is None or question.rdclass != dns.rdataclass.IN or \
+                question.name != version.origin:
+            res.set_rcode(dns.rcode.REFUSED)
+            log.info("Refusing transfer of %s", question.name)
+            return res, None
+
+        res.flags |= dns.flags.AA
+
+        if question.rdtype == dns.rdatatype.AXFR:
+            if not tcp:
+                # full transfers don't fit a datagram
+                res.set_rcode(dns.rcode.REFUSED)
+                res.flags &= ~dns.flags.AA
+                return res, None
+            res.answer.append(version.soa)
+            return res, version.axfr
+
+        res.answer.append(version.soa)
+        if not tcp:
+            # the client should retry over TCP if it's out of date
+            return res, None
+
+        serial = None
+        for rrset in msg.authority:
+            if rrset.rdtype == dns.rdatatype.SOA and len(rrset):
+                serial = rrset[0].serial
+
+        if serial == version.serial:
+            log.info("IXFR client up to date at serial %d", serial)
+            return res, None
+
+        chunks = version.incremental.get(serial)
+        if chunks is None:
+            log.info("IXFR from unknown serial %s, sending full zone", serial)
+            chunks = version.axfr
+        return res, chunks